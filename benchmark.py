@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+"""
+TODO.TXT-CLI-python benchmark.py script (times todo.py operations against a
+disposable TODO_DIR)
+Copyright (C) 2011  Sigmavirus24
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+Usage: python benchmark.py [-n OPS] [benchmark ...]
+       python benchmark.py --check [todo.txt ...]
+"""
+
+import os
+import random
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from subprocess import PIPE, Popen
+
+import todo
+
+CONFIG = todo.CONFIG
+
+
+def setup(items=100):
+	"""
+	Create a throwaway TODO_DIR holding items items, point todo.CONFIG at it
+	and return its path.
+	"""
+	d = tempfile.mkdtemp(prefix="todo_py_bench_")
+	CONFIG["TODO_DIR"] = d
+	CONFIG["STORAGE"] = "file"
+	todo.STORE["store"] = None
+	for key, name in (("TODO_FILE", "todo.txt"), ("DONE_FILE", "done.txt"),
+			("TMP_FILE", "todo.tmp"), ("REPORT_FILE", "report.txt")):
+		CONFIG[key] = os.path.join(d, name)
+		open(CONFIG[key], "w").close()
+	_write_items(items)
+
+	g = CONFIG["GIT"] = todo.git.Git(d)
+	g.init()
+	g.config("user.name", "benchmark")
+	g.config("user.email", "benchmark@localhost")
+	g.add(".")
+	g.commit("-m", "setup")
+	return d
+
+
+def _write_items(items, projects=7):
+	"""
+	Fill todo.txt with items generated items, spread over projects +projects.
+	"""
+	with open(CONFIG["TODO_FILE"], "w") as fd:
+		for i in range(items):
+			fd.write("({0}) item {1} +proj{2} @ctx{3} #{{2011-01-{4:02d}}}\n"
+				.format("ABC"[i % 3], i, i % projects, i % 5, i % 28 + 1))
+
+
+def _fresh_store(items, kind="file", projects=7):
+	"""
+	Fill todo.txt with items generated items and open a store of kind on it,
+	dropping the one opened on what todo.txt held before.
+	"""
+	_write_items(items, projects)
+	CONFIG["STORAGE"] = kind
+	todo.STORE["store"] = None
+	return todo.todo_store()
+
+
+def _touch_todo(i):
+	with open(CONFIG["TODO_FILE"], "a") as fd:
+		fd.write("added {0}\n".format(i))
+
+
+def bench_git_commit(n):
+	"""
+	One 'git commit' process per change.
+	"""
+	for i in range(n):
+		_touch_todo(i)
+		CONFIG["GIT"].commit([CONFIG["TODO_FILE"]], "-m", str(i))
+
+
+def bench_git_pipe_commit(n):
+	"""
+	The same changes committed through one GitPipe.
+	"""
+	pipe = todo.GitPipe(CONFIG["GIT"])
+	for i in range(n):
+		_touch_todo(i)
+		pipe.commit([CONFIG["TODO_FILE"]], str(i))
+	pipe.close()
+
+
+def bench_git_status(n):
+	for i in range(n):
+		CONFIG["GIT"].status()
+
+
+def bench_git_log(n):
+	for i in range(n):
+		CONFIG["GIT"].log("-2")
+
+
+def bench_git_ls_files(n):
+	for i in range(n):
+		CONFIG["GIT"].ls_files()
+
+
+def _diverged(items):
+	"""
+	Build a base list and two versions of it that each re-prioritized,
+	removed and appended different items.
+	"""
+	base = ["item {0} +proj{1}\n".format(i, i % 7) for i in range(items)]
+	ours = ["(A) " + l if i % 10 == 0 else l for i, l in enumerate(base)
+			if i % 20 != 1]
+	ours.extend(["ours {0}\n".format(i) for i in range(items // 20)])
+	theirs = ["(B) " + l if i % 10 == 5 else l for i, l in enumerate(base)
+			if i % 20 != 2]
+	theirs.extend(["theirs {0}\n".format(i) for i in range(items // 20)])
+	return base, ours, theirs
+
+
+def bench_merge_tasks(n):
+	"""
+	Per-task three-way merge of 100000 item lists; only the merges are timed.
+	"""
+	base, ours, theirs = _diverged(100000)
+	start = time.time()
+	for i in range(n):
+		todo.merge_tasks(base, ours, theirs)
+	return time.time() - start
+
+
+def _todo_env(d):
+	"""
+	Configure todo.py to use the TODO_DIR d from a home of its own and return
+	the environment to run it in.
+	"""
+	home = os.path.join(d, ".home")
+	os.mkdir(home)
+	os.symlink(d, os.path.join(home, ".todo"))
+	with open(os.path.join(d, "config"), "w") as fd:
+		for key in ("TODO_FILE", "DONE_FILE", "TMP_FILE", "REPORT_FILE"):
+			fd.write('export {0}="{1}"\n'.format(key, CONFIG[key]))
+		fd.write('export MAINT_INTERVAL="0"\nexport PRI_X=$WHITE\n')
+	return dict(os.environ, HOME=home)
+
+
+def _shell_lines(n):
+	return ["add 'triage {0} +bench'".format(i) if i % 3 == 0 else
+		"pri {0} B".format(i % 50 + 1) if i % 3 == 1 else "ls +bench"
+		for i in range(n)]
+
+
+def bench_cli_commands(n):
+	"""
+	A triage session of adds, pri and ls, one todo.py process per command.
+	"""
+	env = _todo_env(CONFIG["TODO_DIR"])
+	todo_py = os.path.abspath(todo.__file__.replace(".pyc", ".py"))
+	for line in _shell_lines(n):
+		Popen([sys.executable, todo_py] + shlex.split(line), env=env,
+				stdout=PIPE).communicate()
+
+
+def bench_shell_commands(n):
+	"""
+	The same session typed into a single 'todo.py shell'.
+	"""
+	env = _todo_env(CONFIG["TODO_DIR"])
+	todo_py = os.path.abspath(todo.__file__.replace(".pyc", ".py"))
+	Popen([sys.executable, todo_py, "shell"], env=env, stdin=PIPE,
+			stdout=PIPE).communicate("\n".join(_shell_lines(n)) + "\n")
+
+
+STORE_ITEMS = 100000
+
+
+def _cold(store):
+	"""
+	Forget what store kept in memory, like every new todo.py process does.
+	"""
+	todo.TODO_LINES["stamp"] = None
+	store.cache = (None, [])
+
+
+def _store_bench(kind, op):
+	"""
+	Return a benchmark of op done to STORE_ITEMS items in a store of kind.
+	"""
+	def bench(n):
+		store = _fresh_store(STORE_ITEMS, kind, 97)
+		store.count()  # Loads the database.
+		rand = random.Random(0)
+		start = time.time()
+		for i in range(n):
+			_cold(store)
+			k = rand.randint(1, STORE_ITEMS - n)
+			if op == "append":
+				store.append("appended {0} +bench\n".format(i))
+			elif op == "set":
+				store.set({k : "(A) " + store.get(k)})
+			elif op == "delete":
+				store.delete(k)
+			elif op == "tagged":
+				store.tagged("+proj{0}".format(k % 97))
+			elif op == "due":
+				store.due()
+		return time.time() - start
+	return bench
+
+
+PAGE_ITEMS = 20000
+
+
+def _page_bench(by, paged):
+	"""
+	Return a benchmark listing PAGE_ITEMS items by by per op, either all of
+	them the way ls/lsp do or only a screen of them the way --page does.
+	"""
+	funcs = {"pri" : todo.list_todo, "project" : todo.list_project}
+
+	def bench(n):
+		_fresh_store(PAGE_ITEMS)
+		for p in "ABCX":
+			CONFIG["PRI_{0}".format(p)] = "white"
+		start = time.time()
+		for i in range(n):
+			if paged:
+				pages = todo.Pages(todo._page_specs(by, []),
+					todo.todo_padding())
+				pages.fetch(50)
+				[pages.row(r) for r in range(len(pages.rows))]
+			else:
+				todo._render(funcs[by], by == "pri" and ([],) or ())
+		return time.time() - start
+	return bench
+
+
+DUP_ITEMS = 100000
+
+
+def _dup_bench(op):
+	"""
+	Return a benchmark checking one new line per op for a duplicate among
+	DUP_ITEMS items: "lookup" in dup_index() as add does, "load" doing so in a
+	fresh process that reads the sidecar first, or "scan" comparing it with
+	every line.
+	"""
+	def bench(n):
+		_fresh_store(DUP_ITEMS)
+		todo.dup_index()
+		new = corpus(n)
+		start = time.time()
+		for line in new:
+			if op == "scan":
+				key = todo._dup_key(line)
+				[l for l in todo.iter_todos() if todo._dup_key(l) == key]
+			else:
+				if op == "load":
+					todo.DUPS.update(stamp=None)
+				todo._dup_key(line) in todo.dup_index()
+		return time.time() - start
+	return bench
+
+
+THRESHOLD_ITEMS = 100000
+
+
+def _threshold_bench(cached):
+	"""
+	Return a benchmark finding the items hidden by a threshold among
+	THRESHOLD_ITEMS items, a hundredth of them with one, per op: from a
+	threshold index that is up to date, or parsing todo.txt for it again.
+	"""
+	def bench(n):
+		_fresh_store(THRESHOLD_ITEMS)
+		with open(CONFIG["TODO_FILE"], "a") as fd:
+			for i in range(THRESHOLD_ITEMS / 100):
+				fd.write("later {0} t:2099-01-{1:02d}\n".format(i, i % 28 + 1))
+		todo.threshold_index()
+		start = time.time()
+		for i in range(n):
+			if not cached:
+				os.remove(todo._cache_path("thresholds"))
+			todo.hidden_items()
+		return time.time() - start
+	return bench
+
+
+# The regular expressions todo.py used before tokenize(); check_tokenizer()
+# holds the tokenizer to their behavior.
+REGEXES = {
+		"pri" : re.compile('^\\(([A-X])\\)\\s'),
+		"project" : re.compile('\\+(\\w+)'),
+		"context" : re.compile('@(\\w+)'),
+		"due" : re.compile('#\\{(\\d{4})-(\\d{1,2})-(\\d{1,2})\\}'),
+		"done" : re.compile('^x (\\d{4})-(\\d{2})-(\\d{2})\\s'),
+		"hide_project" : re.compile('(\\+\\w+\\s?)'),
+		"hide_context" : re.compile('(@\\w+\\s?)'),
+		"hide_date" : re.compile('(#\\{\\d+-\\d+-\\d+\\}\\s?)'),
+		}
+
+FRAGMENTS = ["(A)", "(B)", "(Y)", "(a)", "x", "2011-01-01", "2011-1-1",
+		"+proj", "+a+b", "a+b", "+", "++c", "+_x9", "@ctx", "me@host.com", "@",
+		"@@d", "#{2011-02-03}", "#{2011-2-3}", "#{12345-1-1}", "#{2011-13-01}",
+		"#{2011-02-03}x", "#{x}", "#{", "+p#{2011-01-01}", "word", "c++",
+		"(A)no", "\t", "  "]
+
+
+def corpus(n, seed=0):
+	"""
+	Generate n item lines mixing the fragments the todo.txt grammar cares about.
+	"""
+	rand = random.Random(seed)
+	lines = []
+	for i in range(n):
+		words = [rand.choice(FRAGMENTS) for j in range(rand.randint(1, 8))]
+		lines.append(" ".join(words).strip(" ") + "\n")
+	return lines
+
+
+def _regex_view(line):
+	"""
+	What the regular expressions saw in line.
+	"""
+	r = REGEXES["pri"].match(line)
+	due = set()
+	for y, m, d in REGEXES["due"].findall(line):
+		due.add(todo._iso_date(y, m, d))
+	due.discard(None)
+	done = REGEXES["done"].match(line)
+	text = line.rstrip("\n")
+	return {
+		"pri" : r and r.group(1),
+		"project" : REGEXES["project"].findall(line),
+		"context" : REGEXES["context"].findall(line),
+		"due" : due,
+		"done" : done and todo._iso_date(*done.groups()),
+		"hide_project" : REGEXES["hide_project"].sub("", text),
+		"hide_context" : REGEXES["hide_context"].sub("", text),
+		"hide_date" : REGEXES["hide_date"].sub("", text),
+		}
+
+
+def _token_view(line):
+	"""
+	The same as _regex_view(), from tokenize().
+	"""
+	tokens = todo.tokenize(line)
+	text = line.rstrip("\n")
+	view = {
+		"pri" : todo.line_priority(line),
+		"project" : [v for k, v, s, e in tokens if k == "project"],
+		"context" : [v for k, v, s, e in tokens if k == "context"],
+		"due" : todo.line_due(tokens),
+		"done" : tokens and tokens[0][0] == "done" and tokens[0][1] or None,
+		}
+	for name, key in (("hide_project", "HIDE_PROJ"),
+			("hide_context", "HIDE_CONT"), ("hide_date", "HIDE_DATE")):
+		for k in ("HIDE_PROJ", "HIDE_CONT", "HIDE_DATE"):
+			CONFIG[k] = k == key
+		view[name] = todo._hide_tags(text)
+	for k in ("HIDE_PROJ", "HIDE_CONT", "HIDE_DATE"):
+		CONFIG[k] = False
+	return view
+
+
+def check_tokenizer(lines):
+	"""
+	Compare tokenize() with the regular expressions on lines. Returns the
+	number of lines that differ, after printing them.
+	"""
+	bad = 0
+	for line in lines:
+		want = _regex_view(line)
+		got = _token_view(line)
+		diff = [k for k in want if want[k] != got[k]]
+		if diff:
+			bad += 1
+			print("{0!r}".format(line))
+			for k in diff:
+				print("\t{0}: regex {1!r} tokenizer {2!r}".format(k, want[k],
+					got[k]))
+	print("{0} of {1} lines conform.".format(len(lines) - bad, len(lines)))
+	return bad
+
+
+def bench_tokenize(n):
+	"""
+	One line through tokenize() per op.
+	"""
+	lines = corpus(n)
+	start = time.time()
+	for line in lines:
+		tokens = todo.tokenize(line)
+		todo.line_priority(line)
+		todo.line_due(tokens)
+	return time.time() - start
+
+
+def bench_regexes(n):
+	"""
+	One line through the regular expressions tokenize() replaced per op.
+	"""
+	lines = corpus(n)
+	rx = REGEXES
+	start = time.time()
+	for line in lines:
+		rx["pri"].match(line)
+		rx["project"].findall(line)
+		rx["context"].findall(line)
+		for y, m, d in rx["due"].findall(line):
+			todo._iso_date(y, m, d)
+		rx["hide_project"].sub("", line)
+		rx["hide_context"].sub("", line)
+		rx["hide_date"].sub("", line)
+	return time.time() - start
+
+
+BENCHMARKS = [
+		("git_commit", bench_git_commit),
+		("git_pipe_commit", bench_git_pipe_commit),
+		("git_status", bench_git_status),
+		("git_log", bench_git_log),
+		("git_ls_files", bench_git_ls_files),
+		("merge_tasks_100k", bench_merge_tasks),
+		("cli_commands", bench_cli_commands),
+		("shell_commands", bench_shell_commands),
+		("tokenize", bench_tokenize),
+		("regexes", bench_regexes),
+		("list_pri", _page_bench("pri", False)),
+		("page_pri", _page_bench("pri", True)),
+		("list_project", _page_bench("project", False)),
+		("page_project", _page_bench("project", True)),
+		("dup_lookup", _dup_bench("lookup")),
+		("dup_load", _dup_bench("load")),
+		("dup_scan", _dup_bench("scan")),
+		("hidden_cached", _threshold_bench(True)),
+		("hidden_parsed", _threshold_bench(False)),
+		]
+for op in ("append", "set", "delete", "tagged", "due"):
+	for kind in ("file", "sqlite"):
+		BENCHMARKS.append(("store_{0}_{1}".format(kind, op),
+			_store_bench(kind, op)))
+del(op, kind)
+
+
+def run(name, func, n):
+	"""
+	Time func(n) in a fresh TODO_DIR and print the cost per operation. If func
+	returns the seconds it spent on the measured part, that is used instead.
+	"""
+	d = setup()
+	try:
+		start = time.time()
+		spent = func(n)
+		total = (spent or time.time() - start) * 1000
+	finally:
+		shutil.rmtree(d)
+	print("{0:<24} {1:>6} ops {2:>10.1f} ms {3:>10.3f} ms/op".format(name, n,
+		total, total / n))
+
+
+if __name__ == "__main__":
+	opts = OptionParser("Usage: %prog [-n OPS] [benchmark ...]")
+	opts.add_option("-n", dest="ops", type="int", default=50,
+			help="Number of operations per benchmark")
+	opts.add_option("--check", action="store_true", default=False,
+			help="Check the tokenizer against the old regular expressions")
+	valid, names = opts.parse_args()
+
+	if valid.check:
+		lines = corpus(20000)
+		for name in names:
+			with open(name) as fd:
+				lines.extend(fd.readlines())
+		sys.exit(check_tokenizer(lines) and 1)
+
+	for name, func in BENCHMARKS:
+		if not names or name in names:
+			run(name, func, valid.ops)
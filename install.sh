@@ -19,6 +19,7 @@ Update(){
 	if ! [[ -z "$(diff $INSTALL_DIR/todo.py todo.py)" ]] && \
 		[[ todo.py -nt $INSTALL_DIR/todo.py ]]; then
 		cp -u todo.py $INSTALL_DIR/todo.py
+		cp -u todo_completion.bash todo_completion.zsh $INSTALL_DIR
 		echo $prog"An old version of todo.py was found and updated."
 	else
 		echo $prog"todo.py is already installed. Exiting..."
@@ -81,6 +82,17 @@ alias_rc=$pre"alias "$alias"='$INSTALL_DIR/todo.py'\n"
 
 echo -e $alias_rc >> $ALIAS_FILE
 echo $prog"Alias '$alias' added to $ALIAS_FILE."
+
+## Tab completion of commands, +projects and @contexts
+echo $prog"Copying the completion scripts to $INSTALL_DIR"
+cp -u ./todo_completion.bash ./todo_completion.zsh $INSTALL_DIR
+if ! grep -q "todo_completion.bash" "$ALIAS_FILE" ; then
+	complete_rc="\n#Completion for todo.py\n"
+	complete_rc=$complete_rc"export TODO_PY_COMMAND='$INSTALL_DIR/todo.py'\n"
+	complete_rc=$complete_rc"source '$INSTALL_DIR/todo_completion.bash'\n"
+	echo -e $complete_rc >> $ALIAS_FILE
+	echo $prog"Completion added to $ALIAS_FILE."
+fi
 echo $prog"To use alias, please run \`source $ALIAS_FILE\`."
 echo $prog"You can also add '$INSTALL_DIR' to your PATH variable."
 echo $prog"Installation complete."
@@ -18,22 +18,263 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+Usage: python profiler.py [-m cprofile|sample|memory] [options] [command ...]
+
+Every command ("pri 2 A", quoted as one argument) is run by todo.py inside
+this process against a throwaway TODO_DIR, so commands that change the list
+can be profiled as well as those that only read it. Memory mode runs each one
+in a forked child and only reports its peak resident size: todo.py needs
+Python 2, which can't tell where memory was allocated.
 """
 
-import pstats
+import atexit
+import cProfile
 import os
-from subprocess import call
+import pstats
+import re
+import resource
+import shlex
+import shutil
+import signal
+import sys
+import time
+import traceback
+from optparse import OptionParser
+
+import benchmark
+
+TODO_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "todo.py")
+
+COMMANDS = ["ls", "lsc", "lsd", "lsp", "h", "status", "log",
+		"add 'profiled item +proj1 @ctx1'",
+		"addm 'first profiled item +proj2\nsecond profiled item @ctx2'",
+		"do 1", "pri 2 A", "dp 3", "app 4 appended text", "undo"]
+
+
+def run_todo(args, repeat):
+	"""
+	Run todo.py with the arguments args repeat times, throwing away what it
+	prints. The functions it registers with atexit, which finish its commits,
+	are run at the end of each run as they would be when the process exits.
+	"""
+	with open(TODO_PY) as fd:
+		code = compile(fd.read(), TODO_PY, "exec")
+	stdout = sys.stdout
+	argv = sys.argv
+	register = atexit.register
+	sys.stdout = open(os.devnull, "w")
+	try:
+		for i in range(repeat):
+			handlers = []
+			atexit.register = lambda func, *a, **kw: handlers.append(
+				(func, a, kw)) or func
+			sys.argv = [TODO_PY] + args
+			try:
+				exec(code, {"__name__" : "__main__", "__file__" : TODO_PY})
+			except SystemExit:
+				pass
+			atexit.register = register
+			for func, a, kw in reversed(handlers):
+				func(*a, **kw)
+	finally:
+		atexit.register = register
+		sys.stdout.close()
+		sys.stdout = stdout
+		sys.argv = argv
+
+
+def _out_path(out, suffix):
+	return ".".join([out, suffix])
+
+
+def _frame_name(filename, name, line):
+	return "{0} ({1}:{2})".format(name, os.path.basename(filename), line)
+
+
+def _collapse(names):
+	"""
+	Return the stack names, outermost first, as a line of a collapsed stack
+	file, leaving out the frames of this script before todo.py was entered.
+	"""
+	for i, name in enumerate(names):
+		if "todo.py:" in name:
+			return ";".join(names[i:])
+	return ";".join(names)
+
+
+class Sampler(object):
+	"""
+	Record the stack of the running code every interval seconds of CPU time,
+	counting how often each stack was seen. A signal handler does the
+	recording, so the code runs at full speed between samples.
+	"""
+	def __init__(self, interval):
+		self.interval = interval
+		self.stacks = {}
+
+	def _sample(self, signum, frame):
+		names = []
+		while frame is not None:
+			code = frame.f_code
+			names.append(_frame_name(code.co_filename, code.co_name,
+				code.co_firstlineno))
+			frame = frame.f_back
+		names.reverse()
+		key = _collapse(names)
+		self.stacks[key] = self.stacks.get(key, 0) + 1
+
+	def start(self):
+		signal.signal(signal.SIGPROF, self._sample)
+		# Don't let a sample interrupt the reads and waits on git.
+		signal.siginterrupt(signal.SIGPROF, False)
+		signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0, 0)
+		signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+
+def _print_top(title, counts, total, unit, limit):
+	print("{0:>10} {1:>6}  {2}".format(unit, "%", title))
+	top = sorted(counts.items(), key=lambda c: c[1], reverse=True)[:limit]
+	for name, count in top:
+		print("{0:>10} {1:>6.1f}  {2}".format(count,
+			100.0 * count / (total or 1), name))
+
+
+def _write_collapsed(stacks, path):
+	"""
+	Write stacks, a dict of collapsed stack: weight, in the format read by
+	flamegraph.pl and speedscope.
+	"""
+	with open(path, "w") as fd:
+		for stack, weight in sorted(stacks.items()):
+			fd.write("{0} {1}\n".format(stack, weight))
+	print("Collapsed stacks written to {0}".format(path))
+
+
+def profile_cprofile(args, valid, out):
+	"""
+	Deterministic profile of every function call, printed by pstats.
+	"""
+	prof = cProfile.Profile()
+	prof.runcall(run_todo, args, valid.repeat)
+	if out:
+		prof.dump_stats(_out_path(out, "prof"))
+	pstats.Stats(prof).strip_dirs().sort_stats(valid.sort).print_stats(
+		valid.limit)
+
+
+def profile_sample(args, valid, out):
+	"""
+	Statistical profile, printing the functions the samples landed in and
+	those on the stack when they did.
+	"""
+	sampler = Sampler(valid.interval / 1000.0)
+	start = time.time()
+	sampler.start()
+	try:
+		run_todo(args, valid.repeat)
+	finally:
+		sampler.stop()
+	spent = time.time() - start
+
+	total = sum(sampler.stacks.values())
+	own = {}
+	inclusive = {}
+	for stack, count in sampler.stacks.items():
+		names = stack.split(";")
+		own[names[-1]] = own.get(names[-1], 0) + count
+		for name in set(names):
+			inclusive[name] = inclusive.get(name, 0) + count
+	print("{0} samples every {1} ms of CPU time in {2:.1f} ms".format(total,
+		valid.interval, spent * 1000))
+	_print_top("self", own, total, "samples", valid.limit)
+	print("")
+	_print_top("on stack", inclusive, total, "samples", valid.limit)
+	if out:
+		_write_collapsed(sampler.stacks, _out_path(out, "sample.folded"))
+
+
+def profile_memory(args, valid, out):
+	"""
+	Peak resident size of a child forked to run the command, and how much of
+	it the command added to the size the child started with. Linux starts the
+	peak of a child over at its size when forked, so what earlier commands
+	used isn't counted. Python 2 has no tracemalloc, so where the memory was
+	allocated isn't known.
+	"""
+	sys.stdout.flush()
+	pid = os.fork()
+	if pid == 0:
+		status = 0
+		try:
+			start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			run_todo(args, valid.repeat)
+			peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			print("Peak resident size {0} KiB, {1} KiB over the {2} KiB the "
+				"child started with".format(peak, peak - start, start))
+		except BaseException:
+			traceback.print_exc()
+			status = 1
+		sys.stdout.flush()
+		os._exit(status)
+	os.waitpid(pid, 0)
+
+
+MODES = {"cprofile" : profile_cprofile, "sample" : profile_sample,
+		"memory" : profile_memory}
+
+
+def profile(command, valid):
+	"""
+	Profile command in a fresh TODO_DIR holding valid.items items.
+	"""
+	args = shlex.split(command)
+	out = None
+	if valid.out:
+		if not os.path.exists(valid.out):
+			os.makedirs(valid.out)
+		out = os.path.join(valid.out, "todo_py_{0}".format(
+			re.sub("\W+", "_", "_".join(args))[:40]))
 
-#commands = ['ls', 'lsc', 'lsd', 'add', 'addm', 'app', 'dp', 'do', 'h', 'pri',
-#'pull', 'push', 'status', 'log']
-commands = ['ls', 'lsc', 'lsd', 'h', 'pull', 'push', 'status', 'log']
+	d = benchmark.setup(valid.items)
+	home = os.environ.get("HOME")
+	try:
+		os.environ["HOME"] = benchmark._todo_env(d)["HOME"]
+		print("=== {0} ({1} items, {2} mode)".format(command, valid.items,
+			valid.mode))
+		MODES[valid.mode](args, valid, out)
+		print("")
+	finally:
+		if home is None:
+			del os.environ["HOME"]
+		else:
+			os.environ["HOME"] = home
+		shutil.rmtree(d)
 
-if not os.path.exists('profiles'):
-	os.makedirs('profiles')
 
-base_file_name = 'profiles/todo_py_'
+if __name__ == "__main__":
+	opts = OptionParser("Usage: %prog [options] [command ...]")
+	opts.add_option("-m", "--mode", dest="mode", default="cprofile",
+			type="choice", choices=sorted(MODES.keys()),
+			help="cprofile (every call), sample (statistical) or memory "
+				"(peak resident size only)")
+	opts.add_option("-n", "--items", dest="items", type="int", default=1000,
+			help="Number of items in the throwaway todo.txt")
+	opts.add_option("-r", "--repeat", dest="repeat", type="int", default=1,
+			help="Run every command this many times in a row")
+	opts.add_option("--interval", dest="interval", type="float", default=1,
+			help="Milliseconds of CPU time between samples")
+	opts.add_option("-s", "--sort", dest="sort", default="cumulative",
+			help="pstats sort key in cprofile mode")
+	opts.add_option("--limit", dest="limit", type="int", default=25,
+			help="Rows to print")
+	opts.add_option("-o", "--out", dest="out", default="",
+			help="Write collapsed stacks (for flamegraph.pl or speedscope) in "
+				"sample mode or cProfile dumps to this directory")
+	valid, names = opts.parse_args()
 
-for com in commands:
-	filename = ''.join([base_file_name, com])
-	call(['python', '-m', 'cProfile', '-o', filename, 'todo.py', com])
-	pstats.Stats(filename).strip_dirs().sort_stats('cumulative').print_stats(25)
+	for command in names or COMMANDS:
+		profile(command, valid)
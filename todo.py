@@ -18,12 +18,24 @@
 # 
 # TLDR: This is licensed under the GPLv3. See LICENSE for more details.
 
+import atexit
+import json
 import os
+import pipes
 import re
+import shlex
+import signal
 import string
 import sys
-from optparse import OptionParser
+import tempfile
+import time
+import traceback
+from optparse import OptionParser, OptionValueError
+from StringIO import StringIO
+from subprocess import PIPE, Popen, STDOUT
+from bisect import bisect_left, bisect_right
 from datetime import datetime, date
+from hashlib import md5
 
 VERSION = "0.1-master_dev"
 
@@ -40,6 +52,12 @@ except NameError:
 	# Python 3 moved the built-in intern() to sys.intern()
 	intern = sys.intern
 
+try:
+	import sqlite3
+except ImportError:
+	# Only needed when STORAGE is sqlite.
+	sqlite3 = None
+
 try:
 	import git
 except ImportError:
@@ -86,7 +104,12 @@ CONFIG = {
 		"TODO_FILE" : _pathc([TODO_DIR, "/todo.txt"]),
 		"TMP_FILE" : _pathc([TODO_DIR, "/todo.tmp"]),
 		"DONE_FILE" : _pathc([TODO_DIR, "/done.txt"]),
+		"DONE_DIR" : _pathc([TODO_DIR, "/done"]),
 		"REPORT_FILE" : _pathc([TODO_DIR, "/report.txt"]),
+		"MAINT_INTERVAL" : "7",
+		"SYNC_DIRS_FILE" : _pathc([TODO_DIR, "/sync_dirs.txt"]),
+		"SYNC_JOBS" : "8",
+		"SYNC_TIMEOUT" : "120",
 		"GIT" : git.Git(TODO_DIR),
 		"PLAIN" : False,
 		"NO_PRI" : False,
@@ -96,66 +119,141 @@ CONFIG = {
 		"HIDE_CONT" : False,
 		"HIDE_DATE" : False,
 		"LEGACY" : False,
+		"DATE_FROM" : None,
+		"DATE_TO" : None,
+		"SYNC_ALL" : False,
+		"WATCH" : False,
+		"PAGE" : False,
+		"WATCH_INTERVAL" : "1",
+		"SHELL_COMMIT_INTERVAL" : "0",
+		"UNDO_LIMIT" : "100",
+		"STORAGE" : "file",
+		"DUPLICATES" : "warn",
+		"SHOW_HIDDEN" : False,
 		}
 for p in PRIORITIES: CONFIG["PRI_{0}".format(p)] = ""
 del(p)
 
+# Set by _git_batch() so that _git_commit() writes to a GitPipe. "queue" holds
+# the commits a lazy store puts off until _git_sync().
+GIT_BATCH = {"on" : False, "pipe" : None, "queue" : []}
+
+# What was made of the text of item lines, formatted or parsed, kept between
+# renderings by watch_list() and the shell: "old" holds the previous
+# rendering's and "new" the current one's. See _cached().
+LINE_CACHE = {"on" : False, "old" : {}, "new" : {}}
+
+# The lines of todo.txt as last read or written, and the _file_stamp() they
+# belong to. See read_todos().
+TODO_LINES = {"stamp" : None, "lines" : []}
+
+# Edits made by the running action, see _journal().
+JOURNAL = []
+
+# The store items are kept in, see todo_store().
+STORE = {"store" : None}
+
+# The duplicate index as last read or updated and the stamp of the store it
+# belongs to: the set of keys, the "key number" words of the sidecar and, once
+# a duplicate was looked up, a dict made of them. See dup_index().
+DUPS = {"stamp" : None, "keys" : set(), "words" : [], "numbers" : None}
+
 
 ### Helper Functions
 def todo_padding():
-	i = 0
-	with open(CONFIG["TODO_FILE"]) as fd:
-		for l in fd:
-			i += 1  # This is just a little bit more obvious.
+	i = todo_store().count()
 	pad = 1
 	while i >= 10:
 		pad += 1
 		i /= 10
 	return pad
 
-def iter_todos():
+def read_todos():
 	"""
-	Opens the file in read-only mode, and returns an iterator for the todos.
+	Return the list of lines in todo.txt. The file is only read again when it
+	changed since it was last read or written by write_todos(), so commands
+	run one after the other in a shell share it. Don't modify the list.
 	"""
-	with open(CONFIG["TODO_FILE"]) as fd:
-		for line in fd:
-			yield line
+	stamp = _file_stamp(CONFIG["TODO_FILE"])
+	if stamp != TODO_LINES["stamp"]:
+		with open(CONFIG["TODO_FILE"]) as fd:
+			data = fd.read()
+		TODO_LINES.update(stamp=stamp, lines=_reread_lines(TODO_LINES["lines"],
+			data))
+	return TODO_LINES["lines"]
 
 
-def separate_line(number):
+def _reread_lines(old, data):
 	"""
-	Takes an integer and returns a string and a list. The string is the item at
-	that position in the list. The list is the rest of the todos.
+	Return the lines of data, the new contents of the file old are the lines
+	of. Only the lines appended or changed since are split off anew; the others
+	are those of old, so their text is found in LINE_CACHE without hashing or
+	comparing it again.
 	"""
-	i = 1
-	lines = []
-	for line in iter_todos():
-		if i != number:
-			lines.append(line)
-		else:
-			separate = line
-		i += 1
-	
-	return separate, lines
+	before = concat(old)
+	if data.startswith(before) and before.endswith("\n"):
+		return old + StringIO(data[len(before):]).readlines()
+	new = StringIO(data).readlines()
+	start = 0
+	stop = min(len(old), len(new))
+	while start < stop and old[start] == new[start]:
+		start += 1
+	end = 0
+	while end < stop - start and old[-1 - end] == new[-1 - end]:
+		end += 1
+	return old[:start] + new[start:len(new) - end] + old[len(old) - end:]
+
+
+def _write_lines(path, lines):
+	"""
+	Replace the contents of path with lines. They are written to a temporary
+	file that is then renamed over path, so nobody ever reads a half written
+	file.
+	"""
+	fd, tmp = tempfile.mkstemp(prefix=".todo.", dir=os.path.dirname(path))
+	try:
+		with os.fdopen(fd, "w") as f:
+			f.writelines(lines)
+		if os.path.exists(path):
+			os.chmod(tmp, os.stat(path).st_mode & 0o777)
+		os.rename(tmp, path)
+	except:
+		os.remove(tmp)
+		raise
+
+
+def write_todos(lines):
+	"""
+	Replace the contents of todo.txt with lines, keeping them for read_todos().
+	"""
+	_write_lines(CONFIG["TODO_FILE"], lines)
+	TODO_LINES.update(stamp=_file_stamp(CONFIG["TODO_FILE"]),
+		lines=list(lines))
+
+
+def iter_todos():
+	"""
+	Returns an iterator for the todos.
+	"""
+	for line in todo_store().lines():
+		yield line
 
 
-def rewrite_file(fd, lines):
+def _valid_item(number):
 	"""
-	Simple wrapper for three lines used all too frequently.
-	Sets the access position to the beginning of the file, truncates the
-	file's length to 0 and then writes all the lines to the file.
+	Return whether there is an item number, printing why not otherwise.
 	"""
-	fd.seek(0, 0)
-	fd.truncate(0)
-	fd.writelines(lines)
+	if 0 < number <= todo_store().count():
+		return True
+	print("TODO: No item {0}.".format(number))
+	return False
 
 
-def rewrite_and_post(line_no, old_line, new_line, lines):
+def rewrite_and_post(line_no, old_line, new_line):
 	"""
 	Wraps the following code used frequently in post-production functions.
 	"""
-	with open(CONFIG["TODO_FILE"], "w") as fd:
-		rewrite_file(fd, lines)
+	todo_store().set({line_no : new_line})
 	post_success(line_no, old_line, new_line)
 
 
@@ -170,10 +268,191 @@ def _git_err(g):
 	sys.exit(g.status)
 
 
+class GitPipe(object):
+	"""
+	A persistent 'git fast-import' process. Each commit is written to its
+	stdin instead of forking 'git commit'; the branch and the index are
+	brought up to date when it is closed.
+	"""
+
+	def __init__(self, repo):
+		self.repo = repo
+		self.top, self.ref = repo.rev_parse("--show-toplevel",
+				"--symbolic-full-name", "HEAD").split("\n")
+		self.ident, stamp, self.tz = repo.var("GIT_COMMITTER_IDENT").rsplit(
+				" ", 2)
+		try:
+			self.parent = repo.rev_parse("--verify", "-q", "HEAD")
+		except git.exc.GitCommandError:
+			self.parent = None  # No commits yet.
+		self.proc = repo.fast_import("--quiet", "--done", istream=PIPE,
+				as_process=True)
+		self.commits = 0
+
+	def commit(self, files, message):
+		"""
+		Commit the current contents of files, or their removal, with message.
+		"""
+		out = [concat(["commit ", self.ref, "\n"]),
+			concat(["committer ", self.ident, " ", str(int(time.time())),
+				" ", self.tz, "\n"]),
+			"data {0}\n".format(len(message)), message, "\n"]
+		if self.parent:
+			out.append(concat(["from ", self.parent, "\n"]))
+			self.parent = None
+		for f in files:
+			name = os.path.relpath(_path(f), self.top)
+			if not os.path.exists(f):
+				out.extend(["D ", name, "\n"])
+				continue
+			with open(f) as fd:
+				data = fd.read()
+			out.extend(["M 100644 inline ", name, "\n",
+				"data {0}\n".format(len(data)), data, "\n"])
+		self.proc.stdin.write(concat(out))
+		self.commits += 1
+
+	def close(self):
+		"""
+		Let fast-import update the branch, then reset the index to it.
+		"""
+		self.proc.stdin.write("done\n")
+		self.proc.stdin.close()
+		self.proc.wait()
+		if self.commits:
+			self.repo.reset("-q")
+
+
+def _git_batch():
+	"""
+	Send the following commits through a single GitPipe until _git_sync().
+	"""
+	GIT_BATCH["on"] = True
+
+
+def _git_sync():
+	"""
+	Finish the current batch of commits, if any, so that the branch and the
+	index are up to date for other git commands. Commits put off by a lazy
+	store are made here as one, after todo.txt is exported.
+	"""
+	pipe = GIT_BATCH["pipe"]
+	queue = GIT_BATCH["queue"]
+	GIT_BATCH.update(on=False, pipe=None, queue=[])
+	try:
+		if pipe:
+			pipe.close()
+		if queue:
+			todo_store().export()
+			files = []
+			for f, message in queue:
+				files.extend([x for x in f if x not in files])
+			if len(queue) > 1:
+				message = concat(["TODO: {0} changes.\n\n".format(len(queue)),
+					concat([m for f, m in queue], "\n")])
+			CONFIG["GIT"].commit(files, "-m", message)
+	except git.exc.GitCommandError, g:
+		_git_err(g)
+	if pipe or queue:
+		_maybe_maintain()
+atexit.register(_git_sync)
+
+
+def _sync_dirs():
+	"""
+	Read the repositories listed in SYNC_DIRS_FILE, one directory per line.
+	Blank lines and lines starting with # are skipped.
+	"""
+	dirs = []
+	with open(CONFIG["SYNC_DIRS_FILE"]) as fd:
+		for line in fd:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				dirs.append(_path(line))
+	return dirs
+
+
+def sync_repos(action, dirs, jobs, timeout):
+	"""
+	Run 'git action' in each of dirs, with at most jobs running at once. A
+	process still running after timeout seconds is killed. Returns a list of
+	(directory, status, seconds, output) in the order the runs finished.
+	"""
+	env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+	devnull = open(os.devnull)
+	pending = list(dirs)
+	running = {}
+	results = []
+	while pending or running:
+		while pending and len(running) < jobs:
+			d = pending.pop(0)
+			out = tempfile.TemporaryFile()
+			try:
+				# In its own process group so that a timeout also kills the
+				# ssh or credential helpers git started.
+				p = Popen(["git", action], cwd=d, env=env, stdin=devnull,
+						stdout=out, stderr=STDOUT, preexec_fn=os.setsid)
+			except OSError, e:
+				results.append((d, "error", 0.0, str(e)))
+				continue
+			running[p] = (d, time.time(), out)
+
+		time.sleep(0.05)
+		for p, (d, start, out) in running.items():
+			status = p.poll()
+			elapsed = time.time() - start
+			if status is None and elapsed > timeout:
+				os.killpg(p.pid, signal.SIGKILL)
+				p.wait()
+				status = "timeout"
+			if status is not None:
+				out.seek(0)
+				results.append((d, status == 0 and "ok" or str(status), elapsed,
+					out.read().strip()))
+				out.close()
+				del running[p]
+	devnull.close()
+	return results
+
+
+def _git_sync_all(action):
+	"""
+	Pull or push every repository in SYNC_DIRS_FILE concurrently and print a
+	summary of how long each took and why any failed.
+	"""
+	try:
+		dirs = _sync_dirs()
+	except IOError, e:
+		print(concat(["TODO: Unable to read SYNC_DIRS_FILE: ", str(e)]))
+		sys.exit(1)
+
+	start = time.time()
+	results = sync_repos(action, dirs, int(CONFIG["SYNC_JOBS"]),
+			float(CONFIG["SYNC_TIMEOUT"]))
+	width = max([len(d) for d in dirs] + [10])
+	fmt = concat(["{0:<", str(width), "}  {1:>7}  {2:>8}"])
+	print(fmt.format("repository", "status", "seconds"))
+	failed = []
+	for d, status, seconds, output in sorted(results, key=lambda r: -r[2]):
+		print(fmt.format(d, status, "{0:.2f}".format(seconds)))
+		if status != "ok":
+			failed.append((d, output))
+	for d, output in failed:
+		print(concat(["\n", d, ":\n", output]))
+	print("--\nTODO: {0} of {1} repositories {2}ed in {3:.2f}s.".format(
+		len(results) - len(failed), len(results), action, time.time() - start))
+	if failed:
+		sys.exit(1)
+
+
 def _git_pull():
 	"""
 	Pull any commits that exist on the remote to the local repository.
 	"""
+	_git_sync()
+	if CONFIG["SYNC_ALL"]:
+		_git_sync_all("pull")
+		return
 	try:
 		print(CONFIG["GIT"].pull())
 	except git.exc.GitCommandError, g:
@@ -184,6 +463,10 @@ def _git_push():
 	"""
 	Push commits made locally to the remote.
 	"""
+	_git_sync()
+	if CONFIG["SYNC_ALL"]:
+		_git_sync_all("push")
+		return
 	try:
 		s = CONFIG["GIT"].push()
 	except git.exc.GitCommandError, g:
@@ -199,6 +482,7 @@ def _git_status():
 	Print the status of the local repository if the version of git is 1.7
 	or later.
 	"""
+	_git_sync()
 	try:
 		print(CONFIG["GIT"].status())
 	except git.exc.GitCommandError, g:
@@ -209,6 +493,7 @@ def _git_log():
 	"""
 	Print the two latest commits in the local repository's log.
 	"""
+	_git_sync()
 	lines = CONFIG["GIT"].log("-2")
 	flines = []
 	commit_re = re.compile("commit")
@@ -227,15 +512,31 @@ def _git_commit(files, message):
 	"""
 	Make a commit to the git repository.
 		* files should be a list like ['file_a', 'file_b'] or ['-a']
+	Inside a _git_batch() the commit is written to a GitPipe instead.
 	"""
+	_journal_commit(message)
+	if todo_store().lazy and "-a" not in files:
+		# Exported and committed together by _git_sync().
+		GIT_BATCH["queue"].append((files, message))
+		print(concat(["TODO: ", concat(files, ", "), " archived."]))
+		return
+	batch = GIT_BATCH["on"] and "-a" not in files
 	try:
-		CONFIG["GIT"].commit(files, "-m", message)
+		if batch:
+			if not GIT_BATCH["pipe"]:
+				GIT_BATCH["pipe"] = GitPipe(CONFIG["GIT"])
+			GIT_BATCH["pipe"].commit(files, message)
+		else:
+			_git_sync()
+			CONFIG["GIT"].commit(files, "-m", message)
 	except git.exc.GitCommandError, g:
 		_git_err(g)
 	if "-a" not in files:
 		print(concat(["TODO: ", concat(files, ", "), " archived."]))
 	else:
 		print(concat(["TODO: ", CONFIG["TODO_DIR"], " archived."]))
+	if not batch:
+		_maybe_maintain()
 
 
 def prompt(*args, **kwargs):
@@ -254,6 +555,18 @@ def prompt(*args, **kwargs):
 	return re.sub(r"\\", "", input)
 
 
+def _cache_path(name):
+	"""
+	Return the path of a cache file named name. Caches are kept inside the
+	repository's .git directory when there is one so that they are never
+	committed nor shown as untracked files.
+	"""
+	git_dir = concat([CONFIG["TODO_DIR"], "/.git"])
+	if os.path.isdir(git_dir):
+		return concat([git_dir, "/todo_py.", name])
+	return concat([CONFIG["TODO_DIR"], "/.todo_py.", name])
+
+
 def print_x_of_y(x, y):
 	t_str = "--\nTODO: {0} of {1} tasks shown"
 	if len(x) > len(y):  # EXTREMELY hack-ish
@@ -264,6 +577,507 @@ def print_x_of_y(x, y):
 ### End Helper Functions
 
 
+### Tokenizer Functions
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+DIGITS = frozenset(string.digits)
+
+
+def line_priority(line):
+	"""
+	Return the priority letter of an item line, or None if it has none. This
+	is the first step of tokenize(), for callers that only need the priority.
+	"""
+	if line[:1] == "(" and line[2:3] == ")" and "A" <= line[1:2] <= "X" and \
+			line[3:4].isspace():
+		return line[1]
+	return None
+
+
+def _scan_date(s, i):
+	"""
+	Match digits-digits-digits at s[i]. Returns the index after the match and
+	the three strings of digits, or None.
+	"""
+	parts = []
+	for k in range(3):
+		start = i
+		while i < len(s) and s[i] in DIGITS:
+			i += 1
+		if i == start or (k < 2 and s[i:i + 1] != "-"):
+			return None
+		parts.append(s[start:i])
+		i += 1
+	return i - 1, tuple(parts)
+
+
+def _day(word):
+	"""
+	Return word as an ISO date if it is a yyyy-mm-dd date, else None.
+	"""
+	r = len(word) == 10 and _scan_date(word, 0)
+	if r and r[0] == 10 and [len(p) for p in r[1]] == [4, 2, 2]:
+		return _iso_date(*r[1])
+	return None
+
+
+def _scan_word(word, offset, tokens):
+	"""
+	Add the tokens of a word containing +, @ or #{ to tokens, offset being the
+	position of word in its line.
+	"""
+	i = plain = 0
+	n = len(word)
+	while i < n:
+		c = word[i]
+		if (c == "+" or c == "@") and word[i + 1:i + 2] in WORD_CHARS:
+			j = i + 1
+			while j < n and word[j] in WORD_CHARS:
+				j += 1
+			kind = "project" if c == "+" else "context"
+		elif c == "#" and word[i + 1:i + 2] == "{":
+			r = _scan_date(word, i + 2)
+			if not (r and word[r[0]:r[0] + 1] == "}"):
+				i += 1
+				continue
+			j = r[0] + 1
+			kind = "date"
+		else:
+			i += 1
+			continue
+
+		if plain < i:
+			tokens.append(("word", word[plain:i], offset + plain, offset + i))
+		value = r[1] if kind == "date" else word[i + 1:j]
+		tokens.append((kind, value, offset + i, offset + j))
+		i = plain = j
+
+	if plain < n:
+		tokens.append(("word", word[plain:], offset + plain, offset + n))
+
+
+def tokenize(line):
+	"""
+	Split an item line into tokens in a single left to right scan. Each token
+	is a tuple (kind, value, start, end) where line[start:end] is its text:
+		* "done": the x of a completed item, value is its completion date
+		* "pri": (A), value is the letter
+		* "created": the yyyy-mm-dd creation date after either of those
+		* "project": +project, value is project
+		* "context": @context, value is context
+		* "date": #{yyyy-mm-dd}, value is a tuple of the digit strings
+		* "threshold": t:yyyy-mm-dd, value is the ISO date
+		* "word": any other run of text, value is the text
+	Whitespace is skipped. Like the regular expressions they replace, tags are
+	recognized anywhere in a word, so 'a+b' holds the project 'b'.
+	"""
+	tokens = []
+	words = line.split()
+	pos = first = 0
+	if line[:1] == "x" and line[1:2].isspace():
+		completed = (len(words) > 1 and line.startswith(words[1], 2) and
+			_day(words[1]) or None)
+		first = pos = 1
+		if completed:
+			first = 2
+			pos = 12
+		tokens.append(("done", completed, 0, pos))
+	elif line_priority(line):
+		tokens.append(("pri", line[1], 0, 3))
+		pos = 3
+		first = 1
+
+	created = len(words) > first and _day(words[first])
+	if created:
+		start = line.find(words[first], pos)
+		pos = start + 10
+		tokens.append(("created", created, start, pos))
+		first += 1
+
+	for word in words[first:]:
+		start = line.find(word, pos)
+		pos = start + len(word)
+		if "+" in word or "@" in word or "#{" in word:
+			_scan_word(word, start, tokens)
+		elif word[:2] == "t:" and _day(word[2:]):
+			tokens.append(("threshold", _day(word[2:]), start, pos))
+		else:
+			tokens.append(("word", word, start, pos))
+	return tokens
+
+
+def _strip_pri(line):
+	"""
+	Return line without its priority.
+	"""
+	return line[4:] if line_priority(line) else line
+
+
+def line_tags(tokens):
+	"""
+	Return the distinct +projects and @contexts among tokens, with their sign.
+	"""
+	return set([concat(["+" if kind == "project" else "@", value])
+		for kind, value, start, end in tokens
+		if kind == "project" or kind == "context"])
+
+
+def line_completed(line):
+	"""
+	Return the completion date of a done item line, if it has one.
+	"""
+	tokens = line.startswith("x") and tokenize(line)
+	return tokens and tokens[0][0] == "done" and tokens[0][1] or None
+
+
+def line_threshold(tokens):
+	"""
+	Return the latest t:yyyy-mm-dd date among tokens, or None.
+	"""
+	days = [value for kind, value, start, end in tokens if kind == "threshold"]
+	return days and max(days) or None
+
+
+def line_due(tokens):
+	"""
+	Return the distinct #{yyyy-mm-dd} dates among tokens as ISO dates.
+	"""
+	due = set()
+	for kind, value, start, end in tokens:
+		if kind == "date":
+			y, m, d = value
+			if len(y) == 4 and len(m) < 3 and len(d) < 3:
+				d = _iso_date(y, m, d)
+				if d:
+					due.add(d)
+	return due
+### End Tokenizer Functions
+
+
+### Storage Functions
+class FileStore(object):
+	"""
+	Items kept in todo.txt itself. Items are numbered from 1 like the lines of
+	todo.txt; set() takes a dict of item number to new line.
+	"""
+	lazy = False
+
+	def stamp(self):
+		"""
+		Something that changes whenever the items do.
+		"""
+		return _file_stamp(CONFIG["TODO_FILE"])
+
+	def lines(self):
+		return read_todos()
+
+	def count(self):
+		return len(read_todos())
+
+	def get(self, number):
+		return read_todos()[number - 1]
+
+	def set(self, changes):
+		lines = list(read_todos())
+		for number, line in changes.items():
+			lines[number - 1] = line
+		write_todos(lines)
+
+	def delete(self, number):
+		lines = list(read_todos())
+		removed = lines.pop(number - 1)
+		write_todos(lines)
+		return removed
+
+	def append(self, line):
+		"""
+		Add line after the last item and return its number.
+		"""
+		lines = read_todos()
+		# A single appended line is atomic enough; keep the cached list warm.
+		with open(CONFIG["TODO_FILE"], "a") as fd:
+			fd.write(line)
+		if not lines or lines[-1].endswith("\n"):
+			TODO_LINES.update(stamp=_file_stamp(CONFIG["TODO_FILE"]),
+				lines=lines + [line])
+		return len(lines) + 1
+
+	def edit(self, ops):
+		"""
+		Make ops, a list of (kind, item number, line) in the order given, the
+		numbers of each counting the ops before it: kind is "set", "insert"
+		or "delete" (line is then ignored).
+		"""
+		lines = list(read_todos())
+		for kind, number, line in ops:
+			if kind == "insert":
+				lines.insert(number - 1, line)
+			elif kind == "delete":
+				del lines[number - 1]
+			else:
+				lines[number - 1] = line
+		write_todos(lines)
+
+	def tagged(self, tag):
+		"""
+		Return the numbers of the items with the +project or @context tag.
+		"""
+		return [i + 1 for i, line in enumerate(read_todos())
+			if tag in line_tags(tokenize(line))]
+
+	def due(self):
+		"""
+		Return a (yyyy-mm-dd, item number) pair for every #{date}.
+		"""
+		due = []
+		for i, line in enumerate(read_todos()):
+			for d in line_due(tokenize(line)):
+				due.append((d, i + 1))
+		return due
+
+	def thresholds(self):
+		"""
+		Return a (yyyy-mm-dd, item number) pair for every item with a
+		t:yyyy-mm-dd threshold. Only lines holding "t:" are parsed.
+		"""
+		pairs = []
+		i = 0
+		for line in self.lines():
+			i += 1
+			if "t:" in line:
+				d = line_threshold(tokenize(line))
+				if d:
+					pairs.append((d, i))
+		return pairs
+
+	def export(self):
+		pass
+
+
+class SQLiteStore(FileStore):
+	"""
+	Items kept in an SQLite database, with indexes on their priority, their
+	+projects and @contexts and their #{dates}, so that changing or finding a
+	few items doesn't mean reading and writing all of todo.txt.
+
+	todo.txt becomes an export: it is only written by export(), which
+	_git_sync() calls before committing, and it is read back in whenever it
+	changed behind the database's back, e.g. with a pull or an editor.
+	"""
+	lazy = True
+
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY,
+			seq INTEGER NOT NULL, text TEXT NOT NULL, pri TEXT);
+		CREATE INDEX IF NOT EXISTS items_seq ON items (seq);
+		CREATE INDEX IF NOT EXISTS items_pri ON items (pri);
+		CREATE TABLE IF NOT EXISTS tags (item INTEGER, tag TEXT);
+		CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+		CREATE INDEX IF NOT EXISTS tags_item ON tags (item);
+		CREATE TABLE IF NOT EXISTS dates (item INTEGER, day TEXT);
+		CREATE INDEX IF NOT EXISTS dates_day ON dates (day);
+		CREATE INDEX IF NOT EXISTS dates_item ON dates (item);
+		CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+		"""
+
+	def __init__(self, path):
+		self.db = sqlite3.connect(path)
+		self.db.text_factory = str
+		self.db.executescript(self.SCHEMA)
+		self.cache = (None, [])
+
+	def _meta(self, key, value=None):
+		if value is None:
+			row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+				(key,)).fetchone()
+			return row and row[0]
+		self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+			(key, str(value)))
+
+	def _version(self):
+		return int(self._meta("version") or 0)
+
+	def _changed(self):
+		self._meta("version", self._version() + 1)
+		self.db.commit()
+
+	def _import(self):
+		"""
+		Load todo.txt unless it is the file last exported or loaded.
+		"""
+		stamp = json.dumps(_file_stamp(CONFIG["TODO_FILE"]))
+		if self._meta("stamp") != stamp:
+			with open(CONFIG["TODO_FILE"]) as fd:
+				self._load(fd.readlines())
+			self._meta("stamp", stamp)
+			self._meta("exported", self._version() + 1)
+			self._changed()
+
+	def _load(self, lines):
+		for table in ("items", "tags", "dates"):
+			self.db.execute(concat(["DELETE FROM ", table]))
+		for i, line in enumerate(lines):
+			self._add(i + 1, line)
+
+	def _add(self, seq, line):
+		item = self.db.execute("INSERT INTO items (seq, text, pri) "
+			"VALUES (?, ?, ?)", (seq, line, line_priority(line))).lastrowid
+		self._index(item, line)
+		return item
+
+	def _index(self, item, line):
+		tokens = tokenize(line)
+		self.db.executemany("INSERT INTO tags VALUES (?, ?)",
+			[(item, tag) for tag in line_tags(tokens)])
+		self.db.executemany("INSERT INTO dates VALUES (?, ?)",
+			[(item, d) for d in line_due(tokens)])
+
+	def _unindex(self, item):
+		self.db.execute("DELETE FROM tags WHERE item = ?", (item,))
+		self.db.execute("DELETE FROM dates WHERE item = ?", (item,))
+
+	def _ids(self):
+		return [row[0] for row in
+			self.db.execute("SELECT id FROM items ORDER BY seq")]
+
+	def _row(self, number):
+		"""
+		Return the id and text of item number.
+		"""
+		row = number > 0 and self.db.execute("SELECT id, text FROM items "
+			"ORDER BY seq LIMIT 1 OFFSET ?", (number - 1,)).fetchone()
+		if not row:
+			raise IndexError(number)
+		return row
+
+	def stamp(self):
+		self._import()
+		return ["sqlite", self._version()]
+
+	def lines(self):
+		self._import()
+		version = self._version()
+		if self.cache[0] != version:
+			self.cache = (version, [row[0] for row in
+				self.db.execute("SELECT text FROM items ORDER BY seq")])
+		return self.cache[1]
+
+	def count(self):
+		self._import()
+		return self.db.execute("SELECT count(*) FROM items").fetchone()[0]
+
+	def get(self, number):
+		self._import()
+		return self._row(number)[1]
+
+	def set(self, changes):
+		self._import()
+		if len(changes) > 8:
+			ids = self._ids()
+			items = [(ids[n - 1], line) for n, line in changes.items()]
+		else:
+			items = [(self._row(n)[0], line) for n, line in changes.items()]
+		for item, line in items:
+			self.db.execute("UPDATE items SET text = ?, pri = ? WHERE id = ?",
+				(line, line_priority(line), item))
+			self._unindex(item)
+			self._index(item, line)
+		self._changed()
+
+	def delete(self, number):
+		self._import()
+		item, removed = self._row(number)
+		self.db.execute("DELETE FROM items WHERE id = ?", (item,))
+		self._unindex(item)
+		self._changed()
+		return removed
+
+	def append(self, line):
+		self._import()
+		seq = self.db.execute("SELECT max(seq) FROM items").fetchone()[0]
+		self._add((seq or 0) + 1, line)
+		self._changed()
+		return self.count()
+
+	def edit(self, ops):
+		# Many ops look their items up in one list of ids rather than by
+		# OFFSET each; it follows the inserts and deletes.
+		self._import()
+		ids = len(ops) > 8 and self._ids()
+		for kind, number, line in ops:
+			if ids is not False:
+				item = number <= len(ids) and ids[number - 1] or None
+			else:
+				try:
+					item = self._row(number)[0]
+				except IndexError:
+					item = None
+			if kind == "insert":
+				if item is None:
+					seq = (self.db.execute("SELECT max(seq) FROM items")
+						.fetchone()[0] or 0) + 1
+				else:
+					seq = self.db.execute("SELECT seq FROM items WHERE id = ?",
+						(item,)).fetchone()[0]
+					self.db.execute("UPDATE items SET seq = seq + 1 "
+						"WHERE seq >= ?", (seq,))
+				item = self._add(seq, line)
+				if ids is not False:
+					ids.insert(number - 1, item)
+			elif kind == "delete":
+				self.db.execute("DELETE FROM items WHERE id = ?", (item,))
+				self._unindex(item)
+				if ids is not False:
+					del ids[number - 1]
+			else:
+				self.db.execute("UPDATE items SET text = ?, pri = ? "
+					"WHERE id = ?", (line, line_priority(line), item))
+				self._unindex(item)
+				self._index(item, line)
+		self._changed()
+
+	def tagged(self, tag):
+		self._import()
+		items = set([row[0] for row in self.db.execute(
+			"SELECT item FROM tags WHERE tag = ?", (tag,))])
+		if not items:
+			return []
+		return [i + 1 for i, item in enumerate(self._ids()) if item in items]
+
+	def due(self):
+		self._import()
+		numbers = dict((item, i + 1) for i, item in enumerate(self._ids()))
+		return [(d, numbers[item]) for d, item in
+			self.db.execute("SELECT day, item FROM dates ORDER BY day")]
+
+	def export(self):
+		"""
+		Write todo.txt if the items changed since it was last written.
+		"""
+		version = self._version()
+		if self._meta("exported") != str(version):
+			write_todos(self.lines())
+			self._meta("stamp", json.dumps(_file_stamp(CONFIG["TODO_FILE"])))
+			self._meta("exported", version)
+			self.db.commit()
+
+
+def todo_store():
+	"""
+	Return the store of the items, as chosen by STORAGE: "file" (todo.txt) or
+	"sqlite".
+	"""
+	if not STORE["store"]:
+		if CONFIG["STORAGE"] != "sqlite":
+			STORE["store"] = FileStore()
+		elif not sqlite3:
+			print("TODO: STORAGE is sqlite but Python has no sqlite3 module.")
+			sys.exit(1)
+		else:
+			STORE["store"] = SQLiteStore(_cache_path("sqlite"))
+	return STORE["store"]
+### End Storage Functions
+
+
 ### Configuration Functions
 def get_config(config_name="", dir_name=""):
 	"""
@@ -394,6 +1208,8 @@ def repo_config():
 		g.config(concat(["branch.", local_branch, ".merge"]),
 				concat(["refs/heads/", remote_branch]))
 
+	_register_merge_driver()
+
 
 def default_config():
 	"""
@@ -436,7 +1252,9 @@ def default_config():
 
 	for k, v in CONFIG.items():
 		if k not in ("GIT", "INVERT", "LEGACY", "PLAIN", "PRE_DATE",
-				"HIDE_DATE", "HIDE_CONT", "HIDE_PROJ", "NO_PRI"):
+				"HIDE_DATE", "HIDE_CONT", "HIDE_PROJ", "NO_PRI",
+				"DATE_FROM", "DATE_TO", "SYNC_ALL", "WATCH",
+				"PAGE", "SHOW_HIDDEN"):
 			if v in TO_CONFIG.keys():
 				cfg.write(concat(["export ", k, "=", TO_CONFIG[v], "\n"]))
 			else:
@@ -455,24 +1273,35 @@ def default_config():
 ### New todo Functions
 def add_todo(line):
 	"""
-	Add a new item to the list of things todo.
+	Add a new item to the list of things todo. If it says the same as an item
+	already there, it is added with a warning or skipped, as DUPLICATES says.
 	"""
 	prepend = CONFIG["PRE_DATE"]
 	_git = CONFIG["GIT"]
-	fd = open(CONFIG["TODO_FILE"], "r+")
-	l = len(fd.readlines()) + 1
-	pri_re = re.compile('(\([A-X]\))')
-	if pri_re.match(line) and prepend:
-		line = pri_re.sub(concat(["\g<1>",
-			datetime.now().strftime(" %Y-%m-%d ")]),
-			line)
+	if line_priority(line) and prepend:
+		line = concat([line[:4], datetime.now().strftime("%Y-%m-%d "),
+			line[4:]])
 	elif prepend:
 		line = concat([datetime.now().strftime("%Y-%m-%d "), line])
-	fd.write(concat([line, "\n"]))
-	fd.close()
+
+	check = CONFIG["DUPLICATES"] in ("warn", "skip")
+	if check:
+		key = _dup_key(line)
+		dup = key in dup_index() and _dup_number(key)
+		if dup and CONFIG["DUPLICATES"] == "skip":
+			print("TODO: '{0}' is already on line {1}, not added.".format(
+				line, dup))
+			return
+
+	l = todo_store().append(concat([line, "\n"]))
+	_journal("TODO_FILE", l, None, concat([line, "\n"]))
+	if check:
+		_dup_added(key, l)
 	s = "TODO: '{0}' added on line {1}.".format(
 		line, l)
 	print(s)
+	if check and dup:
+		print("TODO: It duplicates line {0}.".format(dup))
 	_git_commit([CONFIG["TODO_FILE"]], s)
 
 
@@ -481,11 +1310,98 @@ def addm_todo(lines):
 	Add new items to the list of things todo.
 	"""
 	lines = lines.split("\n")
+	_git_batch()
 	for line in lines:
 		add_todo(line)
+	_git_sync()
 ### End new todo functions
 
 
+### Duplicate Functions
+def _dup_key(line):
+	"""
+	Return a hash of what an item says, leaving out its priority, dates and
+	case, or None if there is nothing else to it.
+	"""
+	words = [line[start:end] for kind, value, start, end in tokenize(line)
+		if kind not in ("done", "pri", "created", "date")]
+	if not words:
+		return None
+	return md5(concat(words, " ").lower()).hexdigest()[:16]
+
+
+def _dup_stamp():
+	return concat(["@", json.dumps(todo_store().stamp(), separators=(",",
+		":"))])
+
+
+def dup_index():
+	"""
+	Return the set of the _dup_key()s of the items. They are kept in a sidecar
+	file of "key number" rows, each update of it ending with an "@stamp -" row
+	holding the stamp of the store it was made from; when the store changed
+	since, the sidecar is made anew from every item.
+	"""
+	stamp = _dup_stamp()
+	if DUPS["stamp"] == stamp:
+		return DUPS["keys"]
+
+	path = _cache_path("dups")
+	try:
+		with open(path) as fd:
+			words = fd.read().split()
+	except IOError:
+		words = []
+
+	if words[-2:-1] != [stamp]:
+		keys = set()
+		words = []
+		i = 0
+		for line in todo_store().lines():
+			i += 1
+			key = _dup_key(line)
+			if key and key not in keys:
+				keys.add(key)
+				words.extend([key, str(i)])
+		rows = ["{0} {1}\n".format(k, n)
+			for k, n in zip(words[0::2], words[1::2])]
+		rows.append(concat([stamp, " -\n"]))
+		_write_lines(path, rows)
+	# Keys are never written twice; the stamps don't look like keys.
+	DUPS.update(stamp=stamp, keys=set(words[0::2]), words=words, numbers=None)
+	return DUPS["keys"]
+
+
+def _dup_number(key):
+	"""
+	Return the number of the item with the _dup_key() key in dup_index().
+	"""
+	if DUPS["numbers"] is None:
+		words = DUPS["words"]
+		DUPS["numbers"] = dict(zip(words[0::2], words[1::2]))
+	return int(DUPS["numbers"][key])
+
+
+def _dup_added(key, number):
+	"""
+	Record that item number, whose _dup_key() is key, was added to the store
+	dup_index() was last up to date with, by appending to the sidecar.
+	"""
+	stamp = _dup_stamp()
+	rows = []
+	if key and key not in DUPS["keys"]:
+		DUPS["keys"].add(key)
+		DUPS["words"].extend([key, str(number)])
+		if DUPS["numbers"] is not None:
+			DUPS["numbers"][key] = str(number)
+		rows.append("{0} {1}\n".format(key, number))
+	rows.append(concat([stamp, " -\n"]))
+	with open(_cache_path("dups"), "a") as fd:
+		fd.writelines(rows)
+	DUPS["stamp"] = stamp
+### End Duplicate Functions
+
+
 ### Start do/del functions
 def do_todo(line):
 	"""
@@ -493,24 +1409,30 @@ def do_todo(line):
 	"""
 	if not line.isdigit():
 		print("Usage: {0} do item#".format(CONFIG["TODO_PY"]))
-	else:
-		removed, lines = separate_line(int(line))
-
-		fd = open(CONFIG["TODO_FILE"], "w")
-		rewrite_file(fd, lines)
-		fd.close()
+	elif _valid_item(int(line)):
+		removed = todo_store().delete(int(line))
+		_journal("TODO_FILE", int(line), removed, None)
 
 		today = datetime.now().strftime("%Y-%m-%d")
-		removed = re.sub("\([A-X]\)\s?", "", removed)
+		if line_priority(removed):
+			removed = removed[4:]
 		removed = "x " + today + " " + removed
 
-		fd = open(CONFIG["DONE_FILE"], "a")
-		fd.write(removed)
-		fd.close()
+		if _done_archived():
+			segment, manifest = _archive_line(removed, today)
+			_journal(os.path.relpath(segment, CONFIG["TODO_DIR"]), None, None,
+				removed)
+			files = [CONFIG["TODO_FILE"], segment, manifest]
+		else:
+			fd = open(CONFIG["DONE_FILE"], "a")
+			fd.write(removed)
+			fd.close()
+			_journal("DONE_FILE", None, None, removed)
+			files = [CONFIG["TODO_FILE"], CONFIG["DONE_FILE"]]
 
 		print(removed[:-1])
 		print("TODO: Item {0} marked as done.".format(line))
-		_git_commit([CONFIG["TODO_FILE"], CONFIG["DONE_FILE"]], removed)
+		_git_commit(files, removed)
 
 
 def delete_todo(line):
@@ -519,12 +1441,9 @@ def delete_todo(line):
 	"""
 	if not line.isdigit():
 		print("Usage: {0} (del|rm) item#".format(CONFIG["TODO_PY"]))
-	else:
-		removed, lines = separate_line(int(line))
-
-		fd = open(CONFIG["TODO_FILE"], "w")
-		rewrite_file(fd, lines)
-		fd.close()
+	elif _valid_item(int(line)):
+		removed = todo_store().delete(int(line))
+		_journal("TODO_FILE", int(line), removed, None)
 
 		removed = "'{0}' deleted.".format(removed[:-1])
 		print(removed)
@@ -552,12 +1471,96 @@ def post_success(item_no, old_line, new_line):
 	"""
 	After changing a line, pring a standard line and commit the change.
 	"""
-	old_line = old_line.rstrip()
-	new_line = new_line.rstrip()
-	print_str = "TODO: Item {0} changed from '{1}' to '{2}'.".format(
-		item_no, old_line, new_line)
-	print(print_str)
-	_git_commit([CONFIG["TODO_FILE"]], print_str)
+	post_changes([(item_no, old_line, new_line)])
+
+
+def post_changes(changes):
+	"""
+	Print a standard line for each (item_no, old_line, new_line) in changes and
+	commit them all at once.
+	"""
+	print_strs = []
+	for item_no, old_line, new_line in changes:
+		_journal("TODO_FILE", item_no, old_line, new_line)
+		print_str = "TODO: Item {0} changed from '{1}' to '{2}'.".format(
+			item_no, old_line.rstrip(), new_line.rstrip())
+		print(print_str)
+		print_strs.append(print_str)
+
+	if len(print_strs) == 1:
+		message = print_strs[0]
+	else:
+		message = concat(["TODO: {0} items changed.\n\n".format(
+			len(print_strs)), concat(print_strs, "\n")])
+	_git_commit([CONFIG["TODO_FILE"]], message)
+
+
+def _selector_args(args, pri=False):
+	"""
+	Return how many of the leading args are item selectors (NUMBER, FIRST-LAST,
+	+project, @context), counting one priority letter as well if pri is set.
+	"""
+	selector_re = re.compile('^(\d+(-\d+)?|[+@]\w+)$')
+	n = 0
+	for arg in args:
+		if selector_re.match(arg):
+			n += 1
+		elif pri and re.match('^[A-Xa-x]$', arg):
+			pri = False
+			n += 1
+		else:
+			break
+	return n
+
+
+def _select_items(store, selectors):
+	"""
+	Return the sorted numbers of the items in store matched by any of the
+	selectors, or None after printing the reason if a selector is invalid.
+	"""
+	numbers = set()
+	count = store.count()
+	for sel in selectors:
+		r = re.match('^(\d+)(?:-(\d+))?$', sel)
+		if r:
+			first = int(r.group(1))
+			last = int(r.group(2) or first)
+			if not 0 < first <= last <= count:
+				print("TODO: No item(s) {0}.".format(sel))
+				return None
+			numbers.update(range(first, last + 1))
+		elif re.match('^[+@]\w+$', sel):
+			numbers.update(store.tagged(sel))
+		else:
+			print("TODO: Invalid item selector '{0}'.".format(sel))
+			return None
+	return sorted(numbers)
+
+
+def change_items(selectors, change):
+	"""
+	Apply change, a function from an old line to a new line, to every item
+	selected, then store them and commit once.
+	"""
+	store = todo_store()
+	numbers = _select_items(store, selectors)
+	if numbers is None:
+		return
+
+	if len(numbers) > 8:
+		lines = store.lines()
+	changes = []
+	for n in numbers:
+		old_line = lines[n - 1] if len(numbers) > 8 else store.get(n)
+		new_line = change(old_line)
+		if new_line != old_line:
+			changes.append((n, old_line, new_line))
+
+	if not changes:
+		print("TODO: No items changed.")
+	else:
+		store.set(dict([(n, new) for n, old, new in changes]))
+		post_changes(changes)
 
 
 def append_todo(args):
@@ -566,50 +1569,42 @@ def append_todo(args):
 	"""
 	if args[0].isdigit():
 		line_no = int(args.pop(0))
-		old_line, lines = separate_line(line_no)
+		if not _valid_item(line_no):
+			return
+		old_line = todo_store().get(line_no)
 		new_line = concat([concat([old_line[:-1], concat(args, " ")],  " "), "\n"],)
-		lines.insert(line_no - 1, new_line)
 
-		rewrite_and_post(line_no, old_line, new_line, lines)
+		rewrite_and_post(line_no, old_line, new_line)
 	else:
 		post_error('append', 'NUMBER', 'string')
 
 
 def prioritize_todo(args):
 	"""
-	Add or modify the priority of the specified item.
+	Add or modify the priority of the specified items. Accepts the priority
+	letter before or after any number of item selectors, e.g.
+		pri 3 A
+		pri A 3 7 12-40 +release
 	"""
-	if args[0].isdigit():
-		line_no = int(args.pop(0))
-		old_line, lines = separate_line(line_no)
-		new_pri = concat(["(", args[0], ") "])
-		r = re.match("(\([A-X]\)\s).*", old_line)
-		if r:
-			new_line = re.sub(re.escape(r.groups()[0]), new_pri, old_line)
-		else:
-			new_line = concat([new_pri, old_line])
-
-		lines.insert(line_no - 1, new_line)
-
-		rewrite_and_post(line_no, old_line, new_line, lines)
-	else:
+	pris = [a for a in args if re.match('^[A-Xa-x]$', a)]
+	selectors = [a for a in args if a not in pris]
+	if len(pris) != 1 or not selectors:
 		post_error('pri', 'NUMBER', 'capital letter')
+		return
+
+	new_pri = concat(["(", pris[0].upper(), ") "])
+	change_items(selectors, lambda line: concat([new_pri, _strip_pri(line)]))
 
 
-def de_prioritize_todo(number):
+def de_prioritize_todo(args):
 	"""
-	Remove priority markings from the beginning of the line if they're there.
-	Don't complain otherwise.
+	Remove priority markings from the beginning of the selected lines if
+	they're there. Don't complain otherwise.
 	"""
-	if number.isdigit():
-		number = int(number)
-		old_line, lines = separate_line(number)
-		new_line = re.sub("(\([A-X]\)\s)", "", old_line)
-		lines.insert(number - 1, new_line)
-
-		rewrite_and_post(number, old_line, new_line, lines)
+	if not args:
+		post_error('depri', 'NUMBER', None)
 	else:
-		post_err('depri', 'NUMBER', None)
+		change_items(args, _strip_pri)
 
 
 def prepend_todo(args):
@@ -620,22 +1615,208 @@ def prepend_todo(args):
 	if args[0].isdigit():
 		line_no = int(args.pop(0))
 		prepend_str = concat(args, " ") + " "
-		old_line, lines = separate_line(line_no)
-		pri_re = re.compile('^(\([A-X]\)\s)')
-
-		if pri_re.match(old_line):
-			new_line = pri_re.sub(concat( ["\g<1>", prepend_str]), old_line)
+		if not _valid_item(line_no):
+			return
+		old_line = todo_store().get(line_no)
+		if line_priority(old_line):
+			new_line = concat([old_line[:4], prepend_str, old_line[4:]])
 		else:
 			new_line = concat([prepend_str, old_line])
 
-		lines.insert(line_no - 1, new_line)
-		
-		rewrite_and_post(line_no, old_line, new_line, lines)
+		rewrite_and_post(line_no, old_line, new_line)
 	else:
 		post_error('prepend', 'NUMBER', 'string')
 ### End Post-production todo functions
 
 
+### Journal Functions
+def _journal(key, line_no, old, new):
+	"""
+	Note that line line_no of the file key went from old to new. old is None
+	for a line inserted, new is None for a line removed and line_no is None
+	for a line appended. See _journal_file() for key.
+	"""
+	JOURNAL.append([key, line_no, old, new])
+
+
+def _journal_file(key):
+	"""
+	Return the path of a journaled file: key is either a CONFIG key such as
+	"TODO_FILE" or a path relative to TODO_DIR.
+	"""
+	if key in CONFIG:
+		return CONFIG[key]
+	return os.path.join(CONFIG["TODO_DIR"], key)
+
+
+def _journal_append(record):
+	"""
+	Append a record to the journal. The journal is a file of one JSON object
+	per line, only ever appended to except by compact_journal().
+	"""
+	with open(_cache_path("journal"), "a") as fd:
+		# latin-1 maps every byte to a character, whatever the encoding.
+		fd.write(concat([json.dumps(record, encoding="latin-1"), "\n"]))
+
+
+def _journal_commit(message):
+	"""
+	Write the edits noted since the last commit to the journal as one
+	operation described by message.
+	"""
+	if JOURNAL:
+		_journal_append({"op" : "change", "msg" : message, "edits" : JOURNAL[:]})
+		del JOURNAL[:]
+
+
+def _journal_records():
+	"""
+	Return the records of the journal, oldest first.
+	"""
+	records = []
+	try:
+		with open(_cache_path("journal")) as fd:
+			for line in fd:
+				try:
+					records.append(json.loads(line))
+				except ValueError:
+					pass  # Cut short by a crash.
+	except IOError:
+		pass
+	return records
+
+
+def _journal_state(records):
+	"""
+	Replay the records. Returns the list of operations that can be undone and
+	the list of those that can be redone, the next one last in both.
+	"""
+	done, undone = [], []
+	for r in records:
+		if r["op"] == "change":
+			done.append(r)
+			del undone[:]
+		elif r["op"] == "undo" and done:
+			undone.append(done.pop())
+		elif r["op"] == "redo" and undone:
+			done.append(undone.pop())
+	return done, undone
+
+
+def compact_journal():
+	"""
+	Rewrite the journal so that it only holds the last UNDO_LIMIT operations
+	that can be undone and those that can be redone.
+	"""
+	done, undone = _journal_state(_journal_records())
+	done = done[max(0, len(done) - int(CONFIG["UNDO_LIMIT"])):]
+	records = done + undone[::-1] + [{"op" : "undo"}] * len(undone)
+	_write_lines(_cache_path("journal"), [concat([json.dumps(r), "\n"])
+		for r in records])
+
+
+def _apply_edits(edits, reverse=False):
+	"""
+	Make the journaled edits, or take them back if reverse is set. Every line
+	is checked to still be what the edit expects first; if one isn't, nothing
+	is written and None is returned. Otherwise returns the keys of the files
+	changed.
+	"""
+	if reverse:
+		edits = [[k, n, new, old] for k, n, old, new in reversed(edits)]
+	files = {}
+	ops = []
+	for key, n, old, new in edits:
+		if key not in files:
+			try:
+				if key == "TODO_FILE":
+					files[key] = list(todo_store().lines())
+				else:
+					files[key] = _read_lines(_journal_file(key))
+			except (IOError, OSError):
+				return None  # Since moved, e.g. by archive.
+		lines = files[key]
+		old = old and old.encode("latin-1")
+		new = new and new.encode("latin-1")
+		if n is None:
+			n = len(lines) + 1 if old is None else len(lines)
+		if old is None:
+			if not 0 < n <= len(lines) + 1:
+				return None
+			lines.insert(n - 1, new)
+			op = ("insert", n, new)
+		elif not 0 < n <= len(lines) or lines[n - 1] != old:
+			return None
+		elif new is None:
+			del lines[n - 1]
+			op = ("delete", n, None)
+		else:
+			lines[n - 1] = new
+			op = ("set", n, new)
+		if key == "TODO_FILE":
+			ops.append(op)
+
+	for key, lines in files.items():
+		if key == "TODO_FILE":
+			# Only the edited items are touched, see the store's edit().
+			todo_store().edit(ops)
+		else:
+			_write_lines(_journal_file(key), lines)
+	return sorted(files)
+
+
+def _journal_step(action):
+	"""
+	Undo or redo, as action says, the next operation in the journal with a
+	single commit.
+	"""
+	records = _journal_records()
+	done, undone = _journal_state(records)
+	ops = done if action == "undo" else undone
+	if not ops:
+		print("TODO: Nothing to {0}.".format(action))
+		return
+
+	op = ops[-1]
+	what = op["msg"].encode("latin-1").split("\n")[0]
+	if what.startswith("TODO: "):
+		what = what[6:]
+	keys = _apply_edits(op["edits"], action == "undo")
+	if keys is None:
+		print("TODO: Can't {0}, the items changed since: {1}".format(action,
+			what))
+		return
+
+	_journal_append({"op" : action})
+	files = [_journal_file(k) for k in keys]
+	if [k for k in keys if k not in CONFIG]:
+		# A segment of the archive changed.
+		write_manifest(read_manifest())
+		files.append(_manifest_path())
+	message = concat(["TODO: ", "Undid" if action == "undo" else "Redid", ": ",
+		what])
+	print(message)
+	_git_commit(files, message)
+	if len(records) > 2 * int(CONFIG["UNDO_LIMIT"]):
+		compact_journal()
+
+
+def undo_todo():
+	"""
+	Take back the last change made by do, del, add, pri, depri, append or
+	prepend that hasn't been undone yet.
+	"""
+	_journal_step("undo")
+
+
+def redo_todo():
+	"""
+	Make the last change undone again.
+	"""
+	_journal_step("redo")
+### End Journal Functions
+
+
 ### HELP
 def cmd_help():
 	print(concat(["Use", CONFIG["TODO_PY"], "-h for option help"], " "))
@@ -652,11 +1833,17 @@ def cmd_help():
 	print("\t\tLast item to do +project @context #{yyyy-mm-dd}")
 	print("\t\tAdds each line as a separate item to your todo.txt file.")
 	print("")
+	print("\t\tAn item that only differs from one already in todo.txt by")
+	print("\t\tits priority, dates or case is added with a warning when")
+	print("\t\tDUPLICATES is warn (the default), skipped when it is skip, and")
+	print("\t\tadded without checking when it is off.")
+	print("")
 	print('\tappend | app NUMBER "text to append"')
 	print('\t\tAppend "text to append" to item NUMBER.')
 	print("")
-	print("\tdepri | dp NUMBER")
-	print("\t\tRemove the priority of the item on line NUMBER.")
+	print("\tdepri | dp NUMBER [FIRST-LAST] [+project] [@context] ...")
+	print("\t\tRemove the priority of the item on line NUMBER, the items")
+	print("\t\tFIRST through LAST and items tagged +project or @context.")
 	print("")
 	print("\tdo NUMBER")
 	print("\t\tMarks item with corresponding number as done and moves it to")
@@ -665,15 +1852,37 @@ def cmd_help():
 	print("\tlist | ls")
 	print("\t\tLists all items in your todo.txt file sorted by priority.")
 	print("")
+	print("\t\tItems with a threshold t:yyyy-mm-dd are left out of ls, lsc,")
+	print("\t\tlsd, lsp and od until that day comes, unless -H is given.")
+	print("")
 	print("\tlistcon | lsc")
 	print("\t\tLists all items in your todo.txt file sorted by context.")
 	print("")
 	print("\tlistdate | lsd")
 	print("\t\tLists all items in your todo.txt file sorted by date.")
+	print("\t\tWith --from and/or --to only items due in that range are")
+	print("\t\tlisted, e.g. 'lsd --to +7' for the next seven days.")
+	print("")
+	print("\tlistdone | lsdn")
+	print("\t\tLists the items in your done.txt file by completion date,")
+	print("\t\tlimited to --from and --to if given.")
+	print("")
+	print("\toverdue | od")
+	print("\t\tLists the items whose #{yyyy-mm-dd} has passed.")
 	print("")
 	print("\tlistproj | lsp")
 	print("\t\tLists all items in your todo.txt file sorted by project title.")
 	print("")
+	print("\t\tWith -w, ls, lsc, lsd and lsp stay on screen and are redrawn")
+	print("\t\twhenever todo.txt changes (checked every WATCH_INTERVAL")
+	print("\t\tseconds) until interrupted with Ctrl-C.")
+	print("")
+	print("\t\tWith --page, ls, lsc, lsd and lsp are shown a screen at a")
+	print("\t\ttime: space/b page down/up, j/k scroll a line, g/G go to the")
+	print("\t\ttop/bottom, n/N go to the next/previous priority or group,")
+	print("\t\tp and a letter go to the first priority or group from that")
+	print("\t\tletter on, q quits.")
+	print("")
 	print("\thelp | h")
 	print("\t\tShows this message and exits.")
 	print("")
@@ -681,13 +1890,18 @@ def cmd_help():
 	print('\t\tAdd "text to prepend" to the beginning of the item.')
 	print("")
 	print("\tpri | p NUMBER [A-X]")
-	print("\t\tAdd priority specified (A, B, or C) to item NUMBER.")
+	print("\tpri | p [A-X] NUMBER [FIRST-LAST] [+project] [@context] ...")
+	print("\t\tAdd priority specified (A, B, or C) to item NUMBER, or to")
+	print("\t\tevery item selected like depri, in a single commit.")
 	print("")
 	print("\tpull")
 	print("\t\tPulls from the remote for your git repository.")
+	print("\t\tWith --all, pulls every repository listed in SYNC_DIRS_FILE,")
+	print("\t\tSYNC_JOBS at a time, giving up after SYNC_TIMEOUT seconds.")
 	print("")
 	print("\tpush")
 	print("\t\tPushs to the remote for your git repository.")
+	print("\t\tWith --all, pushes every repository like 'pull --all'.")
 	print("")
 	print("\tstatus")
 	print("\t\tIf using $(git --version) > 1.7, shows the status of your")
@@ -695,49 +1909,125 @@ def cmd_help():
 	print("")
 	print("\tlog")
 	print("\t\tShows the last two commits in your local git repository.")
+	print("")
+	print("\tmaintain")
+	print("\t\tGarbage collects and repacks your git repository, showing its")
+	print("\t\tsize and git's speed before and after. This also happens")
+	print("\t\tautomatically every MAINT_INTERVAL days (0 disables it).")
+	print("")
+	print("\tmergeconfig")
+	print("\t\tRegisters a git merge driver that merges todo.txt and")
+	print("\t\tdone.txt item by item so that pulls don't stop on conflicts.")
+	print("")
+	print("\tsquash DAYS")
+	print("\t\tReplaces the history older than DAYS days with one commit.")
+	print("\t\tRemotes then need to be updated with 'git push --force'.")
+	print("")
+	print("\treport")
+	print("\t\tAppends the number of open and done items, by priority,")
+	print("\t\t+project and @context, to your report.txt file.")
+	print("")
+	print("\tarchive")
+	print("\t\tMoves done.txt into DONE_DIR, one file per month of")
+	print("\t\tcompletion, with a manifest of their counts and dates. do")
+	print("\t\tthen only appends to the current month and lsdn --from/--to")
+	print("\t\tonly reads the months asked for.")
+	print("")
+	print("\tundo")
+	print("\t\tTakes back the last add, do, del, pri, depri, append or")
+	print("\t\tprepend not undone yet, in one commit. Up to UNDO_LIMIT of")
+	print("\t\tthem are kept.")
+	print("")
+	print("\tredo")
+	print("\t\tMakes the last change undone again.")
+	print("")
+	print("\tshell")
+	print("\t\tReads actions, with their arguments and options, one line at")
+	print("\t\ta time until 'exit' or Ctrl-D. Changes are written as each")
+	print("\t\tline runs but committed at the end, or every")
+	print("\t\tSHELL_COMMIT_INTERVAL seconds if that is not 0.")
+	print("")
+	print("\tcomplete [WORD]")
+	print("\t\tPrints the commands, or the +projects and @contexts if WORD")
+	print("\t\tstarts with + or @, that start with WORD, the most used tags")
+	print("\t\tfirst. Used by todo_completion.bash and todo_completion.zsh.")
 	sys.exit(0)
 ### HELP
 
 
 ### List Printing Functions
+def _cached(kind, line, make):
+	"""
+	Return make(line). While LINE_CACHE is on, what was made of the same kind
+	and text of line in this or the previous rendering is reused.
+	"""
+	if not LINE_CACHE["on"]:
+		return make(line)
+	key = (kind, line)
+	made = LINE_CACHE["new"].get(key)
+	if made is None:
+		made = LINE_CACHE["old"].get(key)
+		if made is None:
+			made = make(line)
+		LINE_CACHE["new"][key] = made
+	return made
+
+
+def _format_line(i, line, pad):
+	"""
+	Format the single item line found at position i, with its number padded
+	to pad digits. Returns the priority category of the item and the line.
+	"""
+	category, color, rest = _cached("format", line, _render_line)
+	return category, concat([color, str(i).zfill(pad), " ", rest])
+
+
+def _render_line(line):
+	"""
+	Does the work of _format_line() that doesn't depend on the item number:
+	returns the category and the parts of the formatted line before and after
+	the number.
+	"""
+	default = TERM_COLORS[CONFIG.get("DEFAULT", "default")]
+	invert = TERM_COLORS["reverse"] if CONFIG["INVERT"] else ""
+
+	category = line_priority(line)
+	if category:
+		if CONFIG["PLAIN"]:
+			color = default
+		else:
+			try:
+				color = TERM_COLORS[CONFIG["PRI_{0}".format(category)]]
+			except:
+				color = TERM_COLORS[CONFIG["PRI_X"]]
+		if CONFIG["NO_PRI"]:
+			line = line[4:]
+	else:
+		category = "X"
+		color = default
+
+	return category, color + invert, concat([line[:-1], default, "\n"])
+
+
 def format_lines(color_only=False):
 	"""
 	Take in a list of lines to do, return them formatted with the TERM_COLORS
 	and organized based upon priority.
 	"""
 	i = 1
-	default = TERM_COLORS[CONFIG.get("DEFAULT", "default")]
-	plain = CONFIG["PLAIN"]
-	no_priority = CONFIG["NO_PRI"]
-	category = ""
-	invert = TERM_COLORS["reverse"] if CONFIG["INVERT"] else ""
-
 	formatted = []
 	if not color_only:
 		formatted = {}
 		for l in PRIORITIES:
 			formatted[l] = []
 
-	pri_re = re.compile('^\(([A-X])\)\s')
 	pad = todo_padding()
+	hidden = hidden_items()
 	for line in iter_todos():
-		r = pri_re.match(line)
-		if r:
-			category = r.groups()[0]
-			if plain:
-				color = default
-			else:
-				try:
-					color = TERM_COLORS[CONFIG["PRI_{0}".format(category)]]
-				except:
-					color = TERM_COLORS[CONFIG["PRI_X"]]
-			if no_priority:
-				line = pri_re.sub("", line)
-		else:
-			category = "X"
-			color = default
-
-		l = concat([color, invert, str(i).zfill(pad), " ", line[:-1], default, "\n"])
+		if i in hidden:
+			i += 1
+			continue
+		category, l = _format_line(i, line, pad)
 		if color_only:
 			formatted.append(l)
 		else:
@@ -747,6 +2037,32 @@ def format_lines(color_only=False):
 	return formatted
 
 
+def _hide_tags(line, tokens=None):
+	"""
+	Strip the +projects, @contexts and #{dates} the user asked to hide, each
+	with the whitespace character following it. tokens are those of line, if
+	the caller already has them.
+	"""
+	hidden = set()
+	for kind, key in (("project", "HIDE_PROJ"), ("context", "HIDE_CONT"),
+			("date", "HIDE_DATE")):
+		if CONFIG[key]:
+			hidden.add(kind)
+	if not hidden:
+		return line
+
+	out = []
+	pos = 0
+	for kind, value, start, end in tokens or tokenize(line):
+		if kind in hidden:
+			out.append(line[pos:start])
+			pos = end
+			if line[pos:pos + 1].isspace() and line[pos:pos + 1] != "\n":
+				pos += 1
+	out.append(line[pos:])
+	return concat(out)
+
+
 def _legacy_sort(items):
 	"""
 	Sort items alphabetically, i.e.
@@ -756,16 +2072,25 @@ def _legacy_sort(items):
 	# (pri_c) Bcd
 	etc., etc., etc.
 	"""
-	line_re = re.compile('^.*\d+\s(\([A-X]\)\s)?')
-	# The .* in the regexp is needed for the \033[* codes
-	keys = [line_re.sub("", i) for i in items]
-	items_dict = dict(zip(keys, items))
-	keys.sort()
-	items = [items_dict[k] for k in keys]
-	return items
+	# Skip the color codes and item number before the first space.
+	return sorted(items, key=lambda i: _strip_pri(i.split(" ", 1)[-1]))
+
+
+def _group_line(by, line):
+	"""
+	Return line without its hidden tags and the keys _list_() groups it under
+	by: its due dates, +projects or @contexts. The keys are a tuple, which
+	unlike a set the garbage collector stops tracking once cached.
+	"""
+	tokens = tokenize(line)
+	if by == "date":
+		keys = line_due(tokens)
+	else:
+		keys = set([value for kind, value, start, end in tokens if kind == by])
+	return _hide_tags(line, tokens), tuple(keys)
 
 
-def _list_(by, regexp):
+def _list_(by):
 	"""
 	Master list_*() function.
 	"""
@@ -775,29 +2100,27 @@ def _list_(by, regexp):
 	sorted = []
 
 	if by in ["date", "project", "context"]:
-		lines = format_lines(color_only=True)
-		regexp = re.compile(regexp)
-		for line in lines:
-			r = regexp.findall(line)
-			if r:
-				line = concat(["\t", line])
-				if by == "date":
-					for tup in r:
-						d = date(int(tup[0]), int(tup[1]), int(tup[2]))
-						if d not in by_list:
-							by_list.append(d)
-							todo[d] = [line]
-						else:
-							todo[d].append(line)
-				elif by in ["project", "context"]:
-					for i in r:
-						if i not in by_list:
-							by_list.append(i)
-							todo[i] = [line]
-						else:
-							todo[i].append(line)
-			else:
+		lines = []
+		pad = todo_padding()
+		hidden = hidden_items()
+		group = lambda l: _group_line(by, l)
+		i = 1
+		for line in iter_todos():
+			if i in hidden:
+				i += 1
+				continue
+			line, keys = _cached(by, line, group)
+			line = _format_line(i, line, pad)[1]
+			lines.append(line)
+			i += 1
+			if not keys:
 				todo[nonetype].append(line)
+			line = concat(["\t", line])
+			for k in keys:
+				if k not in todo:
+					by_list.append(k)
+					todo[k] = []
+				todo[k].append(line)
 
 	elif by == "pri":
 		lines = format_lines()
@@ -806,17 +2129,9 @@ def _list_(by, regexp):
 
 	by_list.sort()
 
-	hide_proj_re = re.compile('(\+\w+\s?)')
-	hide_cont_re = re.compile('(@\w+\s?)')
-	hide_date_re = re.compile('(#\{\d+-\d+-\d+\}\s?)')
-
 	for b in by_list:
-		if CONFIG["HIDE_PROJ"]:
-			todo[b] = [hide_proj_re.sub("", l) for l in todo[b]]
-		if CONFIG["HIDE_CONT"]:
-			todo[b] = [hide_cont_re.sub("", l) for l in todo[b]]
-		if CONFIG["HIDE_DATE"]:
-			todo[b] = [hide_date_re.sub("", l) for l in todo[b]]
+		if by == "pri":
+			todo[b] = [_cached("hide", l, _hide_tags) for l in todo[b]]
 		if CONFIG["LEGACY"]:
 			todo[b] = _legacy_sort(todo[b])
 		if by != "pri":
@@ -840,7 +2155,6 @@ def _list_by_(*args):
 	for p in PRIORITIES:
 		lines.extend(alines[p])
 
-	alines = lines[:]
 	matched_lines = []
 
 	for regexp in relist:
@@ -850,7 +2164,7 @@ def _list_by_(*args):
 		lines = matched_lines[:]
 	
 	print(concat(lines)[:-1])
-	print_x_of_y(lines, alines)
+	print_x_of_y(lines, list(iter_todos()))
 
 
 def list_todo(args=None, plain=False, no_priority=False):
@@ -859,41 +2173,1297 @@ def list_todo(args=None, plain=False, no_priority=False):
 	todo.txt file.
 	"""
 	if not args:
-		lines, sorted = _list_("pri", "")
+		lines, sorted = _list_("pri")
 		print(concat(sorted)[:-1])
-		print_x_of_y(sorted, sorted)
+		print_x_of_y(sorted, list(iter_todos()))
 	else:
 		_list_by_(*args)
 
 
+def _print_by_date(entries, total, what="tasks"):
+	"""
+	Print (date, line) entries, already sorted by date, under a header for each
+	date, followed by the count of entries shown out of total.
+	"""
+	out = []
+	last = None
+	for d, line in entries:
+		if d != last:
+			out.append(concat([d, ":\n"]))
+			last = d
+		out.append(concat(["\t", line]))
+	print(concat(out)[:-1])
+	print("--\nTODO: {0} of {1} {2} shown".format(len(entries), total, what))
+
+
+def _list_due(lo, hi):
+	"""
+	Print the items with a #{yyyy-mm-dd} between lo and hi (inclusive, either
+	may be None) using the date index rather than parsing every line.
+	"""
+	index = date_index()
+	lines = list(iter_todos())
+	pad = todo_padding()
+	hidden = hidden_items()
+	entries = [(d, _format_line(n, _hide_tags(lines[n - 1]), pad)[1])
+			for d, n in _date_range(index["due"], lo, hi) if n not in hidden]
+	_print_by_date(entries, len(lines))
+
+
 def list_date():
 	"""
-	List todo items by date #{yyyy-mm-dd}.
+	List todo items by date #{yyyy-mm-dd}. If --from or --to were given, only
+	the items due within that range are listed.
 	"""
-	lines, sorted = _list_("date", "#\{(\d{4})-(\d{1,2})-(\d{1,2})\}")
+	if CONFIG["DATE_FROM"] or CONFIG["DATE_TO"]:
+		_list_due(CONFIG["DATE_FROM"], CONFIG["DATE_TO"])
+		return
+
+	lines, sorted = _list_("date")
 	print(concat(sorted)[:-1])
-	print_x_of_y(sorted, lines)
+	print_x_of_y(lines, list(iter_todos()))
+
+
+def list_overdue():
+	"""
+	List the items whose #{yyyy-mm-dd} is before today.
+	"""
+	_list_due(CONFIG["DATE_FROM"], _parse_date_arg("-1"))
+
+
+def list_done():
+	"""
+	List the items in done.txt by completion date, limited to --from/--to.
+	"""
+	lo, hi = CONFIG["DATE_FROM"], CONFIG["DATE_TO"]
+	entries = []
+	if _done_archived():
+		# Only the segments of the months asked for are read.
+		manifest = read_manifest()
+		total = sum([v[0] for k, v in manifest.items() if k != "undated"])
+		for name in _segments_between(manifest, lo or "0", hi or "9"):
+			with open(_segment_path(name)) as fd:
+				for line in fd:
+					d = line_completed(line)
+					if d and (not lo or d >= lo) and (not hi or d <= hi):
+						entries.append((d, _hide_tags(line)))
+		entries.sort(key=lambda e: e[0])
+	else:
+		index = date_index()
+		total = len(index["done"][0])
+		with open(CONFIG["DONE_FILE"]) as fd:
+			for d, offset in _date_range(index["done"], lo, hi):
+				fd.seek(offset)
+				entries.append((d, _hide_tags(fd.readline())))
+	_print_by_date(entries, total, "completed tasks")
 
 
 def list_project():
 	"""
 	Organizes items by project +prj they belong to.
 	"""
-	lines, sorted = _list_("project", "\+(\w+)")
+	lines, sorted = _list_("project")
 	print(concat(sorted)[:-1])
-	print_x_of_y(sorted, lines)
+	print_x_of_y(lines, list(iter_todos()))
 
 
 def list_context():
 	"""
 	Organizes items by context @context associated with them.
 	"""
-	lines, sorted = _list_("context", "@(\w+)")
+	lines, sorted = _list_("context")
 	print(concat(sorted)[:-1])
-	print_x_of_y(sorted, lines)
+	print_x_of_y(lines, list(iter_todos()))
 ### End LP Functions
 
 
+### Watch Functions
+def _term_size():
+	"""
+	Return the height and width of the terminal.
+	"""
+	try:
+		import fcntl
+		import struct
+		import termios
+		height, width = struct.unpack("hh", fcntl.ioctl(sys.stdout.fileno(),
+			termios.TIOCGWINSZ, "1234"))
+		if height and width:
+			return height, width
+	except (ImportError, IOError):
+		pass
+	return int(os.getenv("LINES", 24)), int(os.getenv("COLUMNS", 80))
+
+
+def _fit(row, width):
+	"""
+	Cut row to width visible characters, not counting color codes, so that it
+	fills exactly one line of the terminal.
+	"""
+	out = []
+	for part in re.split('(\033\[[0-9;]*m)', row.expandtabs()):
+		if part.startswith("\033"):
+			out.append(part)
+		elif width > 0:
+			out.append(part[:width])
+			width -= len(part)
+	return concat(out)
+
+
+def _redraw(old, new, height, width):
+	"""
+	Rewrite the rows of the screen that differ between the renderings old and
+	new, leaving the others alone. Only the first height rows are drawn.
+	"""
+	out = []
+	for r in range(min(max(len(old), len(new)), height)):
+		row = new[r] if r < len(new) else ""
+		if r >= len(old) or old[r] != row:
+			out.extend(["\033[{0};1H".format(r + 1), _fit(row, width),
+				TERM_COLORS["default"], "\033[K"])
+	sys.stdout.write(concat(out))
+	sys.stdout.flush()
+
+
+def _render(func, args):
+	"""
+	Return the rows func(*args) prints.
+	"""
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		func(*args)
+		return sys.stdout.getvalue().rstrip("\n").split("\n")
+	finally:
+		sys.stdout = stdout
+
+
+def watch_list(func, *args):
+	"""
+	Show the output of the listing func(*args) and keep it up to date. todo.txt
+	is polled every WATCH_INTERVAL seconds; only when it changed is it read
+	again, and then only the lines that changed are split, parsed and
+	formatted anew and only the rows that changed are redrawn.
+	"""
+	interval = float(CONFIG["WATCH_INTERVAL"])
+	stamp = size = None
+	rows = []
+	LINE_CACHE["on"] = True
+	try:
+		while True:
+			new_stamp = todo_store().stamp()
+			new_size = _term_size()
+			if new_stamp != stamp or new_size != size:
+				if new_size != size:
+					sys.stdout.write("\033[2J")
+					rows = []
+				new_rows = _render(func, args)
+				LINE_CACHE.update(old=LINE_CACHE["new"], new={})
+				_redraw(rows, new_rows, new_size[0] - 1, new_size[1])
+				stamp, size, rows = new_stamp, new_size, new_rows
+			time.sleep(interval)
+	except KeyboardInterrupt:
+		sys.stdout.write("\033[{0};1H\n".format(min(len(rows), size[0])))
+	finally:
+		LINE_CACHE.update(on=False, old={}, new={})
+### End Watch Functions
+
+
+### Pager Functions
+class Pages(object):
+	"""
+	The rows of a listing, formatted only once they are shown. specs yields
+	(group, item number, line, prefix) for every row in order, with item
+	number None for the header of group; rows are taken from it as the pager
+	needs them.
+	"""
+	def __init__(self, specs, pad):
+		self.specs = specs
+		self.pad = pad
+		self.rows = []
+		self.starts = []
+		self.formatted = {}
+		self.done = False
+
+	def fetch(self, n=None):
+		"""
+		Take rows from specs until there are n of them, or all if n is None.
+		"""
+		while not self.done and (n is None or len(self.rows) < n):
+			try:
+				spec = next(self.specs)
+			except StopIteration:
+				self.done = True
+				break
+			if not self.rows or self.rows[-1][0] != spec[0]:
+				self.starts.append((len(self.rows), spec[0]))
+			self.rows.append(spec)
+
+	def row(self, r):
+		"""
+		Return row r formatted for the screen.
+		"""
+		if r not in self.formatted:
+			group, number, line, prefix = self.rows[r]
+			if number is None:
+				self.formatted[r] = concat([str(group), ":"])
+			else:
+				self.formatted[r] = concat([prefix, _format_line(number,
+					_cached("hide", line, _hide_tags), self.pad)[1][:-1]])
+		return self.formatted[r]
+
+	def group(self, r):
+		"""
+		Return the group row r belongs to.
+		"""
+		current = None
+		for start, group in self.starts:
+			if start > r:
+				break
+			current = group
+		return current
+
+	def find(self, match, step=100):
+		"""
+		Return the first row starting a group for which match(start, group)
+		holds, fetching more rows until one does or there are none left.
+		"""
+		checked = 0
+		while True:
+			for start, group in self.starts[checked:]:
+				if match(start, group):
+					return start
+			checked = len(self.starts)
+			if self.done:
+				return None
+			self.fetch(len(self.rows) + step)
+
+
+def _page_specs(by, terms):
+	"""
+	Yield the rows of the listing by "pri", "project", "context" or "date" for
+	Pages. Only the priorities or tags of the items are parsed here, with only
+	the items whose number and text hold all of terms kept when listing by
+	"pri"; formatting is left to Pages.row().
+	"""
+	nonetype = concat(["no", by])
+	lo, hi = CONFIG["DATE_FROM"], CONFIG["DATE_TO"]
+	groups = {}
+	hidden = hidden_items()
+	i = 0
+	for line in iter_todos():
+		i += 1
+		if i in hidden:
+			continue
+		if by == "pri":
+			keys = [line_priority(line) or "X"]
+		else:
+			tokens = tokenize(line)
+			if by == "date":
+				keys = [d for d in line_due(tokens)
+					if (not lo or d >= lo) and (not hi or d <= hi)]
+				if not keys and (lo or hi):
+					continue
+			else:
+				keys = set([value for kind, value, start, end in tokens
+					if kind == by])
+			keys = keys or [nonetype]
+		for k in keys:
+			groups.setdefault(k, []).append((i, line))
+
+	names = sorted([k for k in groups.keys() if k != nonetype])
+	if nonetype in groups:
+		names.append(nonetype)
+	pad = todo_padding()
+	for name in names:
+		items = groups.pop(name)
+		if CONFIG["LEGACY"]:
+			items.sort(key=lambda item: _strip_pri(_hide_tags(item[1])))
+		header = by != "pri" and name != nonetype
+		if header:
+			yield (name, None, None, "")
+		for i, line in items:
+			if terms:
+				text = concat([str(i).zfill(pad), " ", line])
+				if [t for t in terms if t not in text]:
+					continue
+			yield (name, i, line, "\t" if header else "")
+
+
+def _read_key():
+	"""
+	Read one key press from the terminal, returning the whole escape sequence
+	for keys that send one.
+	"""
+	key = sys.stdin.read(1)
+	if key == "\033":
+		key = concat([key, sys.stdin.read(1)])
+		if key[1] in "[O":
+			key = concat([key, sys.stdin.read(1)])
+			if key[2].isdigit():
+				key = concat([key, sys.stdin.read(1)])
+	return key
+
+
+PAGER_KEYS = {" " : "page", "f" : "page", "\033[6~" : "page",
+		"b" : "back", "\033[5~" : "back",
+		"j" : "down", "\n" : "down", "\r" : "down", "\033[B" : "down",
+		"\033OB" : "down",
+		"k" : "up", "\033[A" : "up", "\033OA" : "up",
+		"g" : "top", "\033[H" : "top", "\033OH" : "top", "\033[1~" : "top",
+		"G" : "bottom", "\033[F" : "bottom", "\033OF" : "bottom",
+		"\033[4~" : "bottom",
+		"n" : "next", "N" : "prev", "p" : "jump", "q" : "quit",
+		}
+
+
+def _page_move(pages, top, body, action):
+	"""
+	Return the first row to show after action, or None to quit.
+	"""
+	if action == "quit":
+		return None
+	elif action == "page":
+		top += body
+	elif action == "back":
+		top -= body
+	elif action == "down":
+		top += 1
+	elif action == "up":
+		top -= 1
+	elif action == "top":
+		top = 0
+	elif action == "bottom":
+		pages.fetch()
+		top = len(pages.rows)
+	elif action == "next":
+		found = pages.find(lambda start, group: start > top)
+		top = top if found is None else found
+	elif action == "prev":
+		starts = [start for start, group in pages.starts if start < top]
+		top = starts and starts[-1] or 0
+	elif action == "jump":
+		letter = _read_key().lower()
+		found = pages.find(lambda start, group:
+			str(group)[:1].lower() >= letter)
+		top = top if found is None else found
+
+	pages.fetch(top + body)
+	return max(0, min(top, len(pages.rows) - body))
+
+
+def page_list(by, terms=None):
+	"""
+	Show the listing by "pri", "project", "context" or "date" a screen at a
+	time. Only the rows on screen are formatted, so the first screen of a long
+	list shows up as soon as todo.txt is parsed; scrolling formats the rest as
+	it comes into view.
+	"""
+	import termios
+	import tty
+	pages = Pages(_page_specs(by, terms or []), todo_padding())
+	fd = sys.stdin.fileno()
+	saved = termios.tcgetattr(fd)
+	top = 0
+	rows = []
+	size = None
+	try:
+		tty.setcbreak(fd)
+		sys.stdout.write("\033[?1049h\033[?25l")
+		while top is not None:
+			new_size = _term_size()
+			if new_size != size:
+				sys.stdout.write("\033[2J")
+				rows = []
+				size = new_size
+			body = max(size[0] - 1, 1)
+			pages.fetch(top + body)
+			new_rows = [pages.row(r) for r in
+				range(top, min(top + body, len(pages.rows)))]
+			new_rows.extend([""] * (body - len(new_rows)))
+			total = len(pages.rows)
+			new_rows.append(concat([TERM_COLORS["reverse"],
+				" {0}-{1} of {2}{3} ".format(min(top + 1, total),
+					min(top + body, total), total, "" if pages.done else "+"),
+				str(pages.group(top) or ""),
+				"  (space b j k g G n N p<letter> q)"]))
+			_redraw(rows, new_rows, size[0], size[1])
+			rows = new_rows
+			action = PAGER_KEYS.get(_read_key())
+			if action:
+				top = _page_move(pages, top, body, action)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+		sys.stdout.write("\033[?25h\033[?1049l")
+		sys.stdout.flush()
+### End Pager Functions
+
+
+### Shell Functions
+# Actions that read or rewrite refs or prune objects, which the commits still
+# in the shell's GitPipe must reach first.
+GIT_ACTIONS = frozenset(["push", "pull", "status", "log", "squash",
+	"maintain", "mergeconfig"])
+
+
+def _shell_line(opts, commands, line):
+	"""
+	Run a line typed into the shell the way todo.py runs its arguments,
+	except that options only apply to that line.
+	"""
+	try:
+		words = shlex.split(line)
+	except ValueError, e:
+		print("TODO: {0}.".format(e))
+		return
+	if not words:
+		return
+
+	saved = dict(CONFIG)
+	del JOURNAL[:]
+	try:
+		valid, args = opts.parse_args(words)
+		if valid.config or valid.todo_dir:
+			print("TODO: -c and -d can't be used in the shell.")
+		elif args:
+			# Formatted lines are only reused when no option changes them.
+			LINE_CACHE["on"] = len(args) == len(words)
+			if GIT_ACTIONS.intersection([a.lower() for a in args]):
+				_git_sync()
+			_git_batch()
+			run_commands(commands, args)
+	except SystemExit:
+		pass
+	except KeyboardInterrupt:
+		print("")
+	except Exception:
+		# Say what went wrong without losing the session.
+		traceback.print_exc()
+	finally:
+		CONFIG.clear()
+		CONFIG.update(saved)
+		if LINE_CACHE["new"]:
+			LINE_CACHE.update(old=LINE_CACHE["new"], new={})
+		LINE_CACHE["on"] = True
+
+
+def todo_shell(opts, commands):
+	"""
+	Read lines of actions from the terminal and run them until 'exit', 'quit'
+	or EOF. The configuration, todo.txt and its formatted lines stay in
+	memory in between. Every change is written to todo.txt as its line runs,
+	but the commits all go through one GitPipe which is only closed on the
+	way out or, if SHELL_COMMIT_INTERVAL is not 0, once that many seconds
+	passed since it was last closed.
+	"""
+	interval = float(CONFIG["SHELL_COMMIT_INTERVAL"])
+	history = _cache_path("history")
+	synced = [time.time()]
+
+	def sync_due():
+		if interval and time.time() - synced[0] >= interval:
+			_git_sync()
+			synced[0] = time.time()
+
+	try:
+		readline.read_history_file(history)
+	except (NameError, IOError):
+		pass  # No readline or no history yet.
+	LINE_CACHE["on"] = True
+	try:
+		while True:
+			sync_due()
+			try:
+				line = raw_input("todo> ")
+			except EOFError:
+				print("")
+				break
+			except KeyboardInterrupt:
+				print("")
+				continue
+			if line.strip() in ("exit", "quit"):
+				break
+			sync_due()
+			_shell_line(opts, commands, line)
+	finally:
+		LINE_CACHE.update(on=False, old={}, new={})
+		_git_sync()
+		try:
+			readline.write_history_file(history)
+		except (NameError, IOError):
+			pass
+### End Shell Functions
+
+
+### Completion Functions
+def vocabulary(commands):
+	"""
+	Return the [kind, word, count] rows of the vocabulary cache: every tag
+	(+project or @context) with the number of items carrying it, the most
+	used first, then every command. The first row of the cache holds the
+	_file_stamp() of todo.txt and its path, so the completion scripts can
+	read it without starting Python; when todo.txt changed since, the cache
+	is made anew.
+	"""
+	path = _cache_path("vocab")
+	stamp = json.dumps(_file_stamp(CONFIG["TODO_FILE"]), separators=(",",
+		":"))
+	try:
+		with open(path) as fd:
+			rows = [row.split(" ", 2) for row in fd.read().splitlines()]
+		if rows and rows[0][:2] == ["todo", stamp]:
+			return rows[1:]
+	except IOError:
+		pass
+
+	counts = {}
+	for line in todo_store().lines():
+		for tag in line_tags(tokenize(line)):
+			counts[tag] = counts.get(tag, 0) + 1
+	rows = [["tag", tag, str(n)] for tag, n in
+		sorted(counts.items(), key=lambda c: (-c[1], c[0]))]
+	rows.extend([["command", c, "0"] for c in
+		sorted(commands.keys() + ["complete", "shell"])])
+	_write_lines(path, [concat(["todo ", stamp, " ", CONFIG["TODO_FILE"],
+		"\n"])] + [concat([concat(row, " "), "\n"]) for row in rows])
+	return rows
+
+
+def complete_words(commands, words):
+	"""
+	Print the words of the vocabulary that the last of words is the start of:
+	tags if it starts with + or @, commands otherwise.
+	"""
+	prefix = words and words[-1] or ""
+	kind = "tag" if prefix[:1] in ("+", "@") else "command"
+	for k, word, count in vocabulary(commands):
+		if k == kind and word.startswith(prefix):
+			print(word)
+### End Completion Functions
+
+
+### Date Index Functions
+def _iso_date(year, month, day):
+	"""
+	Return the ISO 8601 string of the given date, or None if it is invalid.
+	"""
+	try:
+		return date(int(year), int(month), int(day)).isoformat()
+	except ValueError:
+		return None
+
+
+def _parse_date_arg(arg):
+	"""
+	Understand 'today', '+N' or '-N' (days from today) and 'yyyy-mm-dd'.
+	Returns an ISO 8601 date string or None.
+	"""
+	if arg == "today":
+		arg = "+0"
+	if re.match('^[+-]\d+$', arg):
+		return date.fromordinal(date.today().toordinal() + int(arg)).isoformat()
+	r = re.match('^(\d{4})-(\d{1,2})-(\d{1,2})$', arg)
+	if r:
+		return _iso_date(*r.groups())
+	return None
+
+
+def _file_stamp(path):
+	"""
+	Size and modification time of path, used to tell if a cache is stale.
+	"""
+	st = os.stat(path)
+	return [st.st_size, st.st_mtime]
+
+
+def _sorted_pairs(pairs):
+	"""
+	Turn a list of (key, value) pairs into two parallel lists sorted by key.
+	"""
+	pairs.sort()
+	return [[k for k, v in pairs], [v for k, v in pairs]]
+
+
+def date_index():
+	"""
+	Return the date index, updating its cache first if the files changed:
+		* "due" holds the #{yyyy-mm-dd} dates of todo.txt with line numbers.
+		* "done" holds the completion dates of done.txt with byte offsets, or
+		  nothing once it has been archived.
+	Each is a pair of parallel lists sorted by ISO date so that ranges can be
+	found with bisect. done.txt is only read past the last indexed offset.
+	"""
+	path = _cache_path("dates")
+	index = _read_checkpoint(path) or {}
+	changed = False
+
+	stamp = todo_store().stamp()
+	if index.get("todo") != stamp:
+		index["todo"] = stamp
+		index["due"] = _sorted_pairs(todo_store().due())
+		changed = True
+
+	if _done_archived():
+		start, data, mark = 0, "", None  # See list_done().
+	else:
+		start, data, mark = _done_since(index.get("mark"))
+	if not start:
+		index["done"] = [[], []]
+	if data:
+		keys, offsets = index["done"]
+		new = []
+		for line in data.splitlines(True):
+			d = line_completed(line)
+			if d:
+				new.append((d, start))
+			start += len(line)
+		new.sort()
+		if new and keys and new[0][0] < keys[-1]:
+			new.extend(zip(keys, offsets))
+			index["done"] = _sorted_pairs(new)
+		else:
+			keys.extend([k for k, v in new])
+			offsets.extend([v for k, v in new])
+	if changed or mark != index.get("mark"):
+		index["mark"] = mark
+		_write_checkpoint(path, index)
+
+	return index
+
+
+def threshold_index():
+	"""
+	Return the threshold index, updating its cache first if it is stale:
+		* "pairs" holds the t:yyyy-mm-dd dates of todo.txt with line numbers,
+		  sorted like the pairs of date_index().
+		* "hidden" holds the numbers of the items whose threshold is after
+		  "day", the day it was worked out.
+		* "next" is the first threshold after "day", when the hidden items
+		  change next, or None.
+	Until todo.txt changes or "next" comes, "hidden" is used as it is without
+	parsing anything; when only the day changed, it is found from "pairs".
+	"""
+	path = _cache_path("thresholds")
+	index = _read_checkpoint(path) or {}
+	today = date.today().isoformat()
+
+	stamp = todo_store().stamp()
+	if index.get("todo") == stamp and index.get("day") <= today and \
+			(index.get("next") is None or today < index["next"]):
+		return index
+
+	if index.get("todo") != stamp:
+		index["todo"] = stamp
+		index["pairs"] = _sorted_pairs(todo_store().thresholds())
+	keys, numbers = index["pairs"]
+	i = bisect_right(keys, today)
+	index["day"] = today
+	index["hidden"] = sorted(numbers[i:])
+	index["next"] = keys[i] if i < len(keys) else None
+	_write_checkpoint(path, index)
+	return index
+
+
+def hidden_items():
+	"""
+	Return the set of the numbers of the items to leave out of listings: those
+	whose threshold has yet to come, unless -H was given.
+	"""
+	if CONFIG["SHOW_HIDDEN"]:
+		return set()
+	return set(threshold_index()["hidden"])
+
+
+def _date_range(pair, lo, hi):
+	"""
+	Return the (date, value) entries of an index pair with lo <= date <= hi.
+	Either bound may be None.
+	"""
+	keys, values = pair
+	i = bisect_left(keys, lo) if lo else 0
+	j = bisect_right(keys, hi) if hi else len(keys)
+	return zip(keys[i:j], values[i:j])
+### End Date Index Functions
+
+
+### Archive Functions
+def _manifest_path():
+	return concat([CONFIG["DONE_DIR"], "/manifest"])
+
+
+def _segment_path(name):
+	return concat([CONFIG["DONE_DIR"], "/", name, ".txt"])
+
+
+def _done_archived():
+	"""
+	Whether completed items are kept in DONE_DIR, one segment per month,
+	rather than in done.txt. See archive_done().
+	"""
+	return os.path.exists(_manifest_path())
+
+
+def _scan_segment(path):
+	"""
+	Read a segment and return its manifest entry: [number of items, first and
+	last completion dates (or "-" if none), size in bytes].
+	"""
+	with open(path) as fd:
+		data = fd.read()
+	count = 0
+	days = []
+	for line in data.splitlines():
+		if line.strip():
+			count += 1
+			d = line_completed(line)
+			if d:
+				days.append(d)
+	if not days:
+		days = ["-"]
+	return [count, min(days), max(days), len(data)]
+
+
+def read_manifest():
+	"""
+	Return the manifest, a dict of segment name (yyyy-mm, or undated for the
+	items without a completion date) to its entry. An entry whose size no
+	longer matches its segment, e.g. after a merge or an edit by hand, is
+	rebuilt from the segment; the others are trusted without reading it.
+	"""
+	sizes = {}
+	for f in os.listdir(CONFIG["DONE_DIR"]):
+		if f.endswith(".txt"):
+			sizes[f[:-4]] = os.path.getsize(_segment_path(f[:-4]))
+
+	manifest = {}
+	with open(_manifest_path()) as fd:
+		for line in fd:
+			# Merged manifests may list a segment more than once.
+			fields = line.split()
+			if (len(fields) == 5 and fields[4].isdigit() and
+					sizes.get(fields[0]) == int(fields[4])):
+				manifest[fields[0]] = [int(fields[1]), fields[2], fields[3],
+					int(fields[4])]
+	for name in sizes:
+		if name not in manifest:
+			manifest[name] = _scan_segment(_segment_path(name))
+	return manifest
+
+
+def write_manifest(manifest):
+	_write_lines(_manifest_path(), ["{0} {1} {2} {3} {4}\n".format(name,
+		*manifest[name]) for name in sorted(manifest)])
+
+
+def _segments_between(manifest, lo, hi):
+	"""
+	Return the names of the segments holding items completed between the ISO
+	dates lo and hi, oldest first.
+	"""
+	return [name for name, (count, first, last, size)
+		in sorted(manifest.items()) if first != "-" and last >= lo and
+		first <= hi]
+
+
+def done_files():
+	"""
+	Return the files completed items are kept in.
+	"""
+	if not _done_archived():
+		return [CONFIG["DONE_FILE"]]
+	return [_segment_path(name) for name in sorted(read_manifest())]
+
+
+def _archive_line(line, day):
+	"""
+	Append the item line completed on day to the segment of its month and
+	update the manifest without reading the segment. Returns the paths of the
+	segment and of the manifest.
+	"""
+	manifest = read_manifest()
+	name = day[:7]
+	path = _segment_path(name)
+	new = not os.path.exists(path)
+	with open(path, "a") as fd:
+		fd.write(line)
+	if new:
+		CONFIG["GIT"].add([path])
+
+	count, first, last, size = manifest.get(name, [0, "-", "-", 0])
+	if first == "-":
+		first = last = day
+	manifest[name] = [count + 1, min(first, day), max(last, day),
+		os.path.getsize(path)]
+	write_manifest(manifest)
+	return path, _manifest_path()
+
+
+def archive_done():
+	"""
+	Move the items in done.txt into DONE_DIR, in a segment per month of
+	completion (and one named undated for the others), and from then on keep
+	completed items there. Running it again moves whatever done.txt holds by
+	then, e.g. after it was brought back by a merge.
+	"""
+	moved = {}
+	if os.path.exists(CONFIG["DONE_FILE"]):
+		for line in _read_lines(CONFIG["DONE_FILE"]):
+			if line.strip():
+				d = line_completed(line)
+				moved.setdefault(d[:7] if d else "undated", []).append(line)
+
+	if not os.path.isdir(CONFIG["DONE_DIR"]):
+		os.makedirs(CONFIG["DONE_DIR"])
+	files = []
+	if not _done_archived():
+		open(_manifest_path(), "w").close()
+		files.append(_manifest_path())
+	if moved:
+		manifest = read_manifest()
+		for name in sorted(moved):
+			path = _segment_path(name)
+			with open(path, "a") as fd:
+				fd.writelines(moved[name])
+			manifest[name] = _scan_segment(path)
+			files.append(path)
+		write_manifest(manifest)
+		if _manifest_path() not in files:
+			files.append(_manifest_path())
+	if files:
+		CONFIG["GIT"].add(files)
+
+	tracked = CONFIG["GIT"].ls_files(CONFIG["DONE_FILE"])
+	if os.path.exists(CONFIG["DONE_FILE"]):
+		os.remove(CONFIG["DONE_FILE"])
+		if tracked:
+			files.append(CONFIG["DONE_FILE"])
+	rule = concat([os.path.basename(CONFIG["DONE_DIR"]),
+		"/manifest merge=union"])
+	if _missing_attributes([rule]):
+		files.append(_add_attributes([rule]))
+
+	if not files:
+		print("TODO: Nothing to archive.")
+		return
+	message = "TODO: {0} done items archived by month in {1}.".format(
+		sum([len(v) for v in moved.values()]), CONFIG["DONE_DIR"])
+	print(message)
+	_git_commit(files, message)
+### End Archive Functions
+
+
+### Maintenance Functions
+def _git_stats():
+	"""
+	Measure the size of the repository and how long 'git status' and
+	'git log -2' take, in milliseconds.
+	"""
+	g = CONFIG["GIT"]
+	counts = {}
+	for line in g.count_objects("-v").split("\n"):
+		k, v = line.split(":", 1)
+		counts[k] = v.strip()
+
+	stats = {
+		"size" : int(counts["size"]) + int(counts["size-pack"]),
+		"objects" : int(counts["count"]) + int(counts["in-pack"]),
+		"packs" : int(counts["packs"]),
+		}
+	for name, args in (("status", ()), ("log", ("-2",))):
+		start = time.time()
+		getattr(g, name)(*args)
+		stats[name] = int((time.time() - start) * 1000)
+	return stats
+
+
+def _log_maintenance(action, before, after):
+	"""
+	Print and record the repository statistics from before and after action.
+	"""
+	fmt = "size={size}KiB objects={objects} packs={packs} status={status}ms \
+log={log}ms"
+	line = concat([datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), action,
+		"before", fmt.format(**before), "after", fmt.format(**after)], " ")
+	with open(_cache_path("maintain"), "a") as fd:
+		fd.write(concat([line, "\n"]))
+	print(concat(["TODO: ", line]))
+
+
+def maintain_repo(auto=False):
+	"""
+	Garbage collect and repack the repository. When auto is set git only does
+	so if it thinks the repository needs it.
+	"""
+	before = _git_stats()
+	try:
+		CONFIG["GIT"].gc("--auto" if auto else "--prune", "--quiet")
+	except git.exc.GitCommandError, g:
+		_git_err(g)
+	_log_maintenance("gc", before, _git_stats())
+	compact_journal()
+
+
+def _maybe_maintain():
+	"""
+	Run maintain_repo(auto=True) if MAINT_INTERVAL days went by since the last
+	maintenance. An interval of 0 turns this off.
+	"""
+	try:
+		interval = float(CONFIG["MAINT_INTERVAL"])
+	except ValueError:
+		return
+	try:
+		last = os.path.getmtime(_cache_path("maintain"))
+	except OSError:
+		last = 0
+	if interval > 0 and time.time() - last > interval * 86400:
+		maintain_repo(auto=True)
+
+
+def _rewrite_onto(base, root, ref):
+	"""
+	Rewrite the commits of ref that come after base so that they descend from
+	root instead. Every parent outside of base..ref becomes root.
+	"""
+	g = CONFIG["GIT"]
+	export = g.fast_export("--reference-excluded-parents",
+			"--signed-tags=strip", ref, concat(["^", base]), as_process=True)
+	imp = g.fast_import("--force", "--quiet", istream=PIPE, as_process=True)
+	src, out = export.stdout, imp.stdin
+	parents = set()
+	for line in iter(src.readline, ""):
+		if line.startswith("data "):
+			out.write(line)
+			out.write(src.read(int(line[5:])))
+			continue
+		if line.startswith("commit "):
+			parents = set()
+		elif line.startswith("from ") or line.startswith("merge "):
+			kind, parent = line.split()
+			if not parent.startswith(":"):
+				parent = root
+			if parent in parents:
+				continue
+			parents.add(parent)
+			line = concat([kind, " ", parent, "\n"])
+		out.write(line)
+	out.close()
+	export.wait()
+	imp.wait()
+
+
+def squash_history(days):
+	"""
+	Replace the history older than days days with a single checkpoint commit
+	holding the files as they were at that point, then prune the old objects.
+	"""
+	if not days.isdigit():
+		post_error('squash', 'number of DAYS', None)
+		return
+
+	_git_sync()
+	g = CONFIG["GIT"]
+	cutoff = date.fromordinal(date.today().toordinal() - int(days)).isoformat()
+	try:
+		base = g.rev_list("-1", concat(["--before=", cutoff]), "HEAD")
+		count = int(g.rev_list("--count", base)) if base else 0
+		if count < 2:
+			print("TODO: Nothing to squash before {0}.".format(cutoff))
+			return
+
+		before = _git_stats()
+		ref = g.symbolic_ref("HEAD")
+		root = g.commit_tree(concat([base, "^{tree}"]), "-m",
+				"TODO: {0} commits before {1} squashed.".format(count, cutoff))
+		if g.rev_list("-1", concat([base, "..HEAD"])):
+			_rewrite_onto(base, root, ref)
+		else:
+			g.update_ref(ref, root)
+		g.reset("-q")
+		g.reflog("expire", "--expire=now", "--all")
+		g.gc("--prune=now", "--quiet")
+	except git.exc.GitCommandError, e:
+		_git_err(e)
+
+	_log_maintenance("squash", before, _git_stats())
+	print(concat(["TODO: {0} commits before {1} squashed. ".format(count,
+		cutoff), "Remotes need 'git push --force' to follow."]))
+### End Maintenance Functions
+
+
+### Merge Functions
+def _task_key(line):
+	"""
+	Identify a task regardless of its priority, so that re-prioritizing an item
+	is seen as a change to it rather than a different task.
+	"""
+	return _strip_pri(line).rstrip()
+
+
+def _task_ids(lines):
+	"""
+	Return [(id, line)] for lines where id is the task key, paired with its
+	occurrence number from the second occurrence on to keep duplicates apart.
+	"""
+	seen = {}
+	ids = []
+	task_key = _task_key
+	for line in lines:
+		key = task_key(line)
+		if key in seen:
+			seen[key] += 1
+			ids.append(((key, seen[key]), line))
+		else:
+			seen[key] = 1
+			ids.append((key, line))
+	return ids
+
+
+def merge_tasks(base, ours, theirs):
+	"""
+	Three-way merge lists of lines as sets of tasks, in linear time:
+		* a task changed on one side only takes that change,
+		* a task changed on both sides keeps our version,
+		* a task removed on one side is removed unless the other side changed it,
+		* tasks added on either side are kept, theirs after the item they
+		  followed in their version.
+	Returns the merged lines and the number of tasks both sides changed.
+	"""
+	base_map = dict(_task_ids(base))
+	our_ids = _task_ids(ours)
+	their_ids = _task_ids(theirs)
+	their_map = dict(their_ids)
+
+	merged = []
+	conflicts = 0
+	for tid, o in our_ids:
+		b = base_map.get(tid)
+		if tid not in their_map:
+			if b is None or o != b:
+				merged.append((tid, o))
+			continue
+		t = their_map[tid]
+		if o == b and t != b:
+			o = t
+		elif o != t and t != b:
+			conflicts += 1
+		merged.append((tid, o))
+
+	# Their additions go after the task they followed, or first if none.
+	kept = set(tid for tid, line in merged)
+	after = {}
+	anchor = None
+	for tid, t in their_ids:
+		if tid in kept:
+			anchor = tid
+		elif tid not in base_map or t != base_map[tid]:
+			after.setdefault(anchor, []).append(t)
+
+	lines = after.get(None, [])
+	for tid, line in merged:
+		lines.append(line)
+		lines.extend(after.get(tid, []))
+	return lines, conflicts
+
+
+def _read_lines(path):
+	"""
+	Read the lines of path, making sure the last one ends with a newline.
+	"""
+	with open(path) as fd:
+		lines = fd.read().splitlines(True)
+	if lines and not lines[-1].endswith("\n"):
+		lines[-1] = concat([lines[-1], "\n"])
+	return lines
+
+
+def merge_driver(base_file, our_file, their_file):
+	"""
+	Entry point for git's merge driver (%O %A %B): merge the three versions of
+	a todo.txt or done.txt per task and leave the result in our_file. Always
+	succeeds so that automated pulls never stop on a conflict.
+	"""
+	lines, conflicts = merge_tasks(_read_lines(base_file),
+			_read_lines(our_file), _read_lines(their_file))
+	with open(our_file, "w") as fd:
+		fd.writelines(lines)
+	if conflicts:
+		sys.stderr.write(concat(["TODO: ", str(conflicts), " item(s) changed ",
+			"on both sides, kept the local version.\n"]))
+	return 0
+
+
+def _register_merge_driver():
+	"""
+	Configure the todotxt merge driver and assign it to todo.txt, done.txt and
+	the segments of the archive in .gitattributes.
+	"""
+	g = CONFIG["GIT"]
+	g.config("merge.todotxt.name", "todo.txt per-task merge")
+	# git runs the driver through the shell.
+	g.config("merge.todotxt.driver", concat([pipes.quote(sys.executable), " ",
+		pipes.quote(_path(CONFIG["TODO_PY"])), " merge-driver %O %A %B"]))
+
+	return _add_attributes([concat([os.path.relpath(f, CONFIG["TODO_DIR"]),
+		" merge=todotxt"]) for f in (CONFIG["TODO_FILE"], CONFIG["DONE_FILE"],
+			concat([CONFIG["DONE_DIR"], "/*.txt"]))])
+
+
+def _missing_attributes(lines):
+	"""
+	Return those of lines missing from TODO_DIR/.gitattributes.
+	"""
+	try:
+		with open(concat([CONFIG["TODO_DIR"], "/.gitattributes"])) as fd:
+			present = fd.read().splitlines()
+	except IOError:
+		present = []
+	return [line for line in lines if line not in present]
+
+
+def _add_attributes(lines):
+	"""
+	Add those of lines missing from TODO_DIR/.gitattributes and stage it.
+	"""
+	attributes = concat([CONFIG["TODO_DIR"], "/.gitattributes"])
+	missing = _missing_attributes(lines)
+	with open(attributes, "a") as fd:
+		for line in missing:
+			fd.write(concat([line, "\n"]))
+	CONFIG["GIT"].add([attributes])
+	return attributes
+
+
+def merge_config():
+	"""
+	Register the merge driver in an existing repository.
+	"""
+	attributes = _register_merge_driver()
+	_git_commit([attributes], "TODO: todotxt merge driver registered.")
+### End Merge Functions
+
+
+### Report Functions
+def _read_checkpoint(path):
+	"""
+	Load a JSON checkpoint, returning None if it is missing or unreadable.
+	"""
+	try:
+		with open(path) as fd:
+			return json.load(fd)
+	except (IOError, ValueError):
+		return None
+
+
+def _write_checkpoint(path, data):
+	"""
+	Store a JSON checkpoint.
+	"""
+	with open(path, "w") as fd:
+		json.dump(data, fd)
+
+
+def _count_tags(line, counts, idx):
+	"""
+	Add one to counts[tag][idx] for each distinct +project and @context in
+	line.
+	"""
+	for tag in line_tags(tokenize(line)):
+		counts.setdefault(tag, [0, 0])[idx] += 1
+
+
+def _done_since(mark, path=None):
+	"""
+	Return the complete lines appended to done.txt, or path, since mark, a
+	list of [offset, tail length, tail md5] recorded by a previous call, along
+	with the offset they start at and the new mark. If the file no longer
+	matches mark (it shrank or was rewritten) all of it is returned from
+	offset 0.
+	"""
+	with open(path or CONFIG["DONE_FILE"]) as fd:
+		start = 0
+		if mark:
+			offset, tail_len, tail_md5 = mark
+			fd.seek(max(offset - tail_len, 0))
+			if md5(fd.read(tail_len)).hexdigest() == tail_md5:
+				start = offset
+		fd.seek(start)
+		data = fd.read()
+		# Leave a partially written last line for the next run.
+		data = data[:data.rfind("\n") + 1]
+		offset = start + len(data)
+		fd.seek(max(offset - 64, 0))
+		tail = fd.read(min(offset, 64))
+
+	return start, data, [offset, len(tail), md5(tail).hexdigest()]
+
+
+def _scan_done(ckpt, path):
+	"""
+	Fold the items completed in path since the checkpoint ckpt into it.
+	"""
+	start, data, mark = _done_since(ckpt and ckpt["mark"], path)
+	if not start:
+		ckpt = {"done" : 0, "tags" : {}}
+
+	for line in data.splitlines():
+		if line.strip():
+			ckpt["done"] += 1
+			_count_tags(line, ckpt["tags"], 1)
+
+	ckpt["mark"] = mark
+	return ckpt
+
+
+def report_todo():
+	"""
+	Append a timestamped line of counts to the report file:
+		TIMESTAMP OPEN DONE A:n ... +project:open/done @context:open/done
+	Completed items are aggregated incrementally from a checkpoint per file so
+	that only the part of done.txt, or of the archive's segments, written
+	since the last report is read.
+	"""
+	ckpt_file = _cache_path("report")
+	old = _read_checkpoint(ckpt_file) or {}
+	ckpt = {}
+	done = 0
+	tags = {}
+	for path in done_files():
+		name = os.path.relpath(path, CONFIG["TODO_DIR"])
+		ckpt[name] = _scan_done(old.get(name), path)
+		done += ckpt[name]["done"]
+		for k, v in ckpt[name]["tags"].items():
+			tags[k] = [0, tags.get(k, [0, 0])[1] + v[1]]
+
+	pris = {}
+	open_count = 0
+	for line in iter_todos():
+		if not line.strip():
+			continue
+		open_count += 1
+		p = line_priority(line)
+		if p:
+			pris[p] = pris.get(p, 0) + 1
+		_count_tags(line, tags, 0)
+
+	fields = [datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), str(open_count),
+			str(done)]
+	fields.extend(["{0}:{1}".format(k, pris[k]) for k in sorted(pris)])
+	fields.extend(["{0}:{1}/{2}".format(t, v[0], v[1])
+		for t, v in sorted(tags.items())])
+	report = concat(fields, " ")
+
+	with open(CONFIG["REPORT_FILE"], "a") as fd:
+		fd.write(concat([report, "\n"]))
+	_write_checkpoint(ckpt_file, ckpt)
+
+	print(report)
+	_git_commit([CONFIG["REPORT_FILE"]], "TODO: report generated.")
+### End Report Functions
+
+
 ### Callback functions for options
 def version(option, opt, value, parser):
 	print("""TODO.TXT Command Line Interface v{version}
@@ -916,17 +3486,31 @@ def toggle_opt(option, opt_str, val, parser):
 	"""
 	Check opt_str to see if it's one of ['-+', '-@', '-#', '-p', '-P', '-t',
 	'--plain-mode', '--no-priority', '--prepend-date', '-i',
-	'--invert-colors'] and toggle that option in CONFIG.
+	'--invert-colors', '--all', '-w', '--watch', '--page', '-H',
+	'--show-hidden'] and toggle that option in CONFIG.
 	"""
 	toggle_dict = {"-+" : "HIDE_PROJ", "-@" : "HIDE_CONT", "-#" : "HIDE_DATE",
 			"-p" : "PLAIN", "-P" : "NO_PRI", "-t" : "PRE_DATE",
 			"--plain-mode" : "PLAIN", "--no-priority" : "NO_PRI",
 			"--prepend-date" : "PRE_DATE", "-i" : "INVERT",
 			"--invert-colors" : "INVERT", "-l" : "LEGACY",
-			"--legacy" : "LEGACY",
+			"--legacy" : "LEGACY", "--all" : "SYNC_ALL",
+			"-w" : "WATCH", "--watch" : "WATCH", "--page" : "PAGE",
+			"-H" : "SHOW_HIDDEN", "--show-hidden" : "SHOW_HIDDEN",
 			}
 	if opt_str in toggle_dict.keys():
 		CONFIG[toggle_dict[opt_str]] = not CONFIG[toggle_dict[opt_str]]
+
+
+def date_opt(option, opt_str, value, parser):
+	"""
+	Store the bound given with --from or --to as an ISO date.
+	"""
+	d = _parse_date_arg(value)
+	if not d:
+		raise OptionValueError("option {0}: invalid date: {1}".format(opt_str,
+			value))
+	CONFIG[{"--from" : "DATE_FROM", "--to" : "DATE_TO"}[opt_str]] = d
 ### End callback functions
 
 
@@ -979,11 +3563,91 @@ def opt_setup():
 	opts.add_option("-#", action="callback", callback=toggle_opt,
 			help="Toggle display of #{dates} in-line with items."
 			)
+	opts.add_option("-w", "--watch", action="callback", callback=toggle_opt,
+			help="Toggle redrawing ls, lsc, lsd and lsp when todo.txt changes."
+			)
+	opts.add_option("--page", action="callback", callback=toggle_opt,
+			help="Toggle showing ls, lsc, lsd and lsp a screen at a time."
+			)
+	opts.add_option("-H", "--show-hidden", action="callback",
+			callback=toggle_opt,
+			help="Toggle listing items whose t:yyyy-mm-dd is still to come."
+			)
+	opts.add_option("--all", action="callback", callback=toggle_opt,
+			help="Toggle pulling or pushing every repository in SYNC_DIRS_FILE."
+			)
+	opts.add_option("--from", action="callback", callback=date_opt,
+			type="string", nargs=1,
+			help=concat(["Only list items dated on or after this day ",
+				"(yyyy-mm-dd, today, +N or -N days)"])
+			)
+	opts.add_option("--to", action="callback", callback=date_opt,
+			type="string", nargs=1,
+			help=concat(["Only list items dated on or before this day ",
+				"(yyyy-mm-dd, today, +N or -N days)"])
+			)
 	return opts
 
 
+def run_commands(commands, args):
+	"""
+	Run every action in args with the arguments following it, looking them up
+	in commands, a dict of action: (takes arguments, function).
+	"""
+	commandsl = [intern(key) for key in commands.keys()]
+
+	pageable = {"ls" : "pri", "list" : "pri", "lsc" : "context",
+			"listcon" : "context", "lsd" : "date", "listdate" : "date",
+			"lsp" : "project", "listproj" : "project"}
+
+	append_re = re.compile('app(?:end)?')
+	prepend_re = re.compile('pre(?:end)?')
+
+	while args:
+		# ensure this doesn't error because of a faulty CAPS LOCK key
+		arg = args.pop(0).lower()
+		if arg in commandsl:
+			if CONFIG["WATCH"] and arg in ["ls", "list", "lsc", "listcon",
+					"lsd", "listdate", "lsp", "listproj"]:
+				if commands[arg][0]:
+					watch_list(commands[arg][1], args)
+				else:
+					watch_list(commands[arg][1])
+				args = None
+			elif CONFIG["PAGE"] and arg in pageable and \
+					sys.stdin.isatty() and sys.stdout.isatty():
+				# Only ls takes arguments, the terms to look for.
+				page_list(pageable[arg], args)
+				args = None
+			elif not commands[arg][0]:
+				commands[arg][1]()
+			else:
+				if append_re.match(arg) or arg in ["ls", "list"]:
+					commands[arg][1](args)
+					args = None
+				elif arg in ["p", "pri", "dp", "depri"]:
+					n = _selector_args(args, arg in ["p", "pri"])
+					commands[arg][1](args[:n])
+					args = args[n:]
+				elif prepend_re.match(arg):
+					commands[arg][1](args[:2])
+					args = args[2:]
+				else:
+					commands[arg][1](args.pop(0))
+		else:
+			commandsl.sort()
+			commandsl = ["\t" + i for i in commandsl]
+			print("Unable to find command: {0}".format(arg))
+			print("Valid commands: ")
+			print(concat(commandsl, "\n"))
+			sys.exit(1)
+
+
 if __name__ == "__main__" :
 	CONFIG["TODO_PY"] = sys.argv[0]
+	if sys.argv[1:2] == ["merge-driver"]:
+		# Run by git in the middle of a merge; don't touch the repository.
+		sys.exit(merge_driver(*sys.argv[2:5]))
 	opts = opt_setup()
 
 	valid, args = opts.parse_args()
@@ -1012,6 +3676,10 @@ if __name__ == "__main__" :
 			"listcon"	: (False, list_context),
 			"lsd"		: (False, list_date),
 			"listdate"	: (False, list_date),
+			"lsdn"		: (False, list_done),
+			"listdone"	: (False, list_done),
+			"od"		: (False, list_overdue),
+			"overdue"	: (False, list_overdue),
 			"lsp"		: (False, list_project),
 			"listproj"	: (False, list_project),
 			"h"			: (False, cmd_help),
@@ -1021,38 +3689,24 @@ if __name__ == "__main__" :
 			"pull"		: (False, _git_pull),
 			"status"	: (False, _git_status),
 			"log"		: (False, _git_log),
+			"report"	: (False, report_todo),
+			"maintain"	: (False, maintain_repo),
+			"squash"	: ( True, squash_history),
+			"mergeconfig"	: (False, merge_config),
+			"archive"	: (False, archive_done),
+			"undo"		: (False, undo_todo),
+			"redo"		: (False, redo_todo),
 			}
-	commandsl = [intern(key) for key in commands.keys()]
 
 	if not len(args) > 0:
 		args.append(CONFIG["TODOTXT_DEFAULT_ACTION"])
 
-	append_re = re.compile('app(?:end)?')
-	pri_re = re.compile('p(?:ri)?')
-	prepend_re = re.compile('pre(?:end)?')
-
-	while args:
-		# ensure this doesn't error because of a faulty CAPS LOCK key
-		arg = args.pop(0).lower()
-		if arg in commandsl:
-			if not commands[arg][0]:
-				commands[arg][1]()
-			else:
-				if append_re.match(arg) or arg in ["ls", "list"]:
-					commands[arg][1](args)
-					args = None
-				elif pri_re.match(arg) or prepend_re.match(arg):
-					commands[arg][1](args[:2])
-					args = args[2:]
-				else:
-					commands[arg][1](args.pop(0))
-		else:
-			commandsl.sort()
-			commandsl = ["\t" + i for i in commandsl]
-			print("Unable to find command: {0}".format(arg))
-			print("Valid commands: ")
-			print(concat(commandsl, "\n"))
-			sys.exit(1)
+	if args == ["shell"]:
+		todo_shell(opts, commands)
+	elif args[:1] == ["complete"]:
+		complete_words(commands, args[1:])
+	else:
+		run_commands(commands, args)
 
 
 # vim:set noet:
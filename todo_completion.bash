@@ -0,0 +1,48 @@
+# Bash completion for todo.py
+#
+# Source this file from ~/.bashrc. Commands are completed after todo.py and
+# its options, +projects and @contexts anywhere after that, the most used
+# first. The words are read from the vocabulary cache todo.py keeps in
+# $TODO_DIR/.git/todo_py.vocab, so completing doesn't start Python; only when
+# todo.txt is newer than the cache is "todo.py complete" run to remake it.
+#
+# TODO_DIR defaults to ~/.todo and TODO_PY_COMMAND, the todo.py to run, to
+# todo.py on the PATH.
+
+_todo_py_vocab()
+{
+	# Sets vocab for _todo_py(), remaking the cache if it is out of date.
+	vocab=${TODO_DIR:-$HOME/.todo}/.git/todo_py.vocab
+	local kind stamp todo_file
+	[[ -r $vocab ]] && read -r kind stamp todo_file < "$vocab"
+	if [[ ! -r $vocab || -z $todo_file || $todo_file -nt $vocab ]]; then
+		"${TODO_PY_COMMAND:-todo.py}" complete > /dev/null 2>&1
+	fi
+}
+
+_todo_py()
+{
+	local cur=${COMP_WORDS[COMP_CWORD]}
+	local want=command vocab kind word count i
+	COMPREPLY=()
+
+	for (( i = 1; i < COMP_CWORD; i++ )); do
+		case ${COMP_WORDS[i]} in
+			-c | -d | --config | --dir | --from | --to ) (( i++ )) ;;
+			-* ) ;;
+			* ) want=none ;;
+		esac
+	done
+	[[ $cur == [+@]* ]] && want=tag
+	[[ $want == none ]] && return
+
+	_todo_py_vocab
+	while read -r kind word count; do
+		[[ $kind == "$want" && $word == "$cur"* ]] && COMPREPLY+=("$word")
+	done < "$vocab"
+	# Keep the most used tags first where bash can.
+	compopt -o nosort 2> /dev/null
+	return 0
+}
+
+complete -F _todo_py todo.py t tpy